@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import tempfile
+import contextlib
+import statistics
+import threading
+import subprocess
+import http.server
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+plugin_dir = os.path.join(benchmarks_dir, '..')
+
+sys.path.insert(0, plugin_dir)
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return stats(times)
+
+
+def stats(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'min': times[0],
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'max': times[-1],
+    }
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=plugin_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+
+    return {
+        'revision': revision or None,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def make_temp_dir():
+    return tempfile.mkdtemp(prefix='migaku_mpv_bench_')
+
+
+def print_result(result):
+    print(json.dumps(result, indent=4, ensure_ascii=False))
+
+
+# The plugin logs to stdout, keep it free for the results
+def log_to_stderr():
+    return contextlib.redirect_stdout(sys.stderr)
+
+
+# Stands in for the connection a handler responds to
+class NullSocket():
+
+    def sendall(self, data):
+        pass
+
+
+### Synthetic subtitles
+
+sample_lines = [
+    '今日はいい天気ですね。',
+    'そうですね、散歩に行きましょうか。',
+    '駅の近くに新しい喫茶店ができたらしいよ。',
+    'Ça ne fait rien, on y va quand même.',
+]
+
+
+def sub_text(i, ascii_only=False):
+    if ascii_only:
+        return 'Line number %d, nothing special here.' % i
+    return sample_lines[i % len(sample_lines)] if i % 4 != 3 else 'Line %d' % i
+
+
+def srt_time(ms):
+    return '%02d:%02d:%02d,%03d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def ass_time(ms):
+    return '%d:%02d:%02d.%02d' % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms // 10 % 100)
+
+
+def make_srt(line_count, ascii_only=False):
+    parts = []
+    for i in range(line_count):
+        start = i * 2000
+        parts.append('%d\n%s --> %s\n%s\n\n' % (i + 1, srt_time(start), srt_time(start + 1800), sub_text(i, ascii_only)))
+    return ''.join(parts)
+
+
+def make_ass(line_count, ascii_only=False):
+    parts = [
+        '[Script Info]\nScriptType: v4.00+\nPlayResX: 1920\nPlayResY: 1080\n\n',
+        '[V4+ Styles]\n',
+        'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, '
+        'Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n',
+        'Style: Default,Arial,55,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,3,0,2,10,10,22,1\n\n',
+        '[Events]\nFormat: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n',
+    ]
+    for i in range(line_count):
+        start = i * 2000
+        parts.append('Dialogue: 0,%s,%s,Default,,0,0,0,,{\\i1}%s\n' % (ass_time(start), ass_time(start + 1800), sub_text(i, ascii_only)))
+    return ''.join(parts)
+
+
+### Stand-ins for external programs
+
+# Writes an executable python script, returns its path
+def write_script(directory, name, source):
+    path = os.path.join(directory, name + '.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('#!' + sys.executable + '\n' + source)
+    os.chmod(path, 0o755)
+    return path
+
+
+# Creates every output file ffmpeg would write, enough for card export
+stub_ffmpeg_source = '''
+import sys
+args = sys.argv[1:]
+for i, arg in enumerate(args):
+    if i > 0 and args[i - 1] == '-i':
+        continue
+    if arg.rsplit('.', 1)[-1] in ('mp3', 'wav', 'ogg', 'jpg', 'png', 'webp'):
+        with open(arg, 'wb') as f:
+            f.write(b'\\0' * 1024)
+'''
+
+
+# Leaves the file unchanged
+stub_rubysubs_source = '''
+import sys
+sys.exit(0)
+'''
+
+
+# Speaks the worker protocol of utils/rubysubs_worker.py without styling anything
+stub_rubysubs_worker_source = '''
+import sys
+import json
+print(json.dumps({'ready': True}), flush=True)
+for line in sys.stdin:
+    json.loads(line)
+    print(json.dumps({'ok': True}), flush=True)
+'''
+
+
+### Fake Migaku add-on
+
+class FakeAddonHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/info':
+            self.send_json({ 'col_media_path': self.server.col_media_path })
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        json.loads(self.rfile.read(length))
+        if self.path == '/sendcard':
+            self.server.card_count += 1
+            self.send_json({ 'status': 'received' })
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_addon(col_media_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeAddonHandler)
+    server.daemon_threads = True
+    server.col_media_path = col_media_path
+    server.card_count = 0
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    return server
+
+
+### Fake mpv IPC
+
+# Accepts one connection on a unix socket and answers every command with success
+class FakeMpvIpcServer():
+
+    def __init__(self, path):
+        self.path = path
+        self.commands = []
+        self.listen_socket = socket.socket(socket.AF_UNIX)
+        self.listen_socket.bind(path)
+        self.listen_socket.listen(1)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        conn, _ = self.listen_socket.accept()
+        buffer = b''
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    command = json.loads(line)
+                    self.commands.append(command['command'])
+                    if 'request_id' in command:
+                        reply = { 'request_id': command['request_id'], 'error': 'success', 'data': None }
+                        conn.sendall(json.dumps(reply).encode() + b'\n')
+
+    def close(self):
+        self.listen_socket.close()
@@ -0,0 +1,58 @@
+import json
+import argparse
+
+
+# Flattens a result document to {path: value} for all timing medians and throughput values
+def flatten(data, path=''):
+    ret = {}
+
+    if isinstance(data, dict):
+        if 'median' in data and 'runs' in data:
+            ret[path] = data['median']
+            return ret
+        for key, value in data.items():
+            if key == 'environment':
+                continue
+            ret.update(flatten(value, path + '/' + str(key) if path else str(key)))
+
+    elif isinstance(data, list):
+        for i, value in enumerate(data):
+            # Entries of result lists are named by their parameters
+            if isinstance(value, dict):
+                params = [str(v) for k, v in value.items() if isinstance(v, (str, int)) and k not in ('runs',) and not k.endswith('_bytes')]
+                name = ','.join(params) or str(i)
+            else:
+                name = str(i)
+            ret.update(flatten(value, path + '[' + name + ']'))
+
+    elif isinstance(data, float) and (path.endswith('seconds') or path.endswith('per_second')):
+        ret[path] = data
+
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares two result files of run_all.py')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change that is reported')
+    args = parser.parse_args()
+
+    with open(args.old, encoding='utf-8') as f:
+        old = flatten(json.load(f))
+    with open(args.new, encoding='utf-8') as f:
+        new = flatten(json.load(f))
+
+    for path in sorted(old.keys() & new.keys()):
+        if old[path] <= 0:
+            continue
+        change = new[path] / old[path] - 1
+        if abs(change) < args.threshold:
+            continue
+        # Throughput gets better when it increases, times when they decrease
+        better = change > 0 if path.endswith('per_second') else change < 0
+        print('%-8s %+7.1f%%  %s' % ('faster' if better else 'SLOWER', change * 100, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import shutil
+import argparse
+
+import common
+
+import migaku_mpv
+from utils.ankiexport import AnkiExporter
+from utils.mpv_ipc import MpvIpc
+
+
+def make_cards(count):
+    cards = []
+    for i in range(count):
+        start = i * 2000
+        cards.append({
+            'text': common.sub_text(i),
+            'translation_text': 'Translation %d' % i,
+            'unknowns': ['天気'],
+            'start': start,
+            'end': start + 1800,
+        })
+    return cards
+
+
+# ffmpeg and media can be given to measure real media generation instead of the stub
+def run(repeat, mass_export_size, ffmpeg=None, media=None, batch_max_gap=None):
+    # The stand-ins for ffmpeg and mpv need executable scripts and unix sockets
+    if os.name != 'posix':
+        return {
+            'benchmark': 'export_card',
+            'skipped': 'Requires a posix system',
+        }
+
+    tmp_dir = common.make_temp_dir()
+    col_media_path = os.path.join(tmp_dir, 'collection.media')
+    os.makedirs(col_media_path)
+
+    media_file = media
+    if media_file is None:
+        media_file = os.path.join(tmp_dir, 'media.mkv')
+        open(media_file, 'wb').close()
+
+    addon = common.start_fake_addon(col_media_path)
+    ipc_server = common.FakeMpvIpcServer(os.path.join(tmp_dir, 'mpv.sock'))
+
+    exporter = AnkiExporter()
+    exporter.ffmpeg_executable = ffmpeg or common.write_script(tmp_dir, 'ffmpeg', common.stub_ffmpeg_source)
+    if batch_max_gap is not None:
+        exporter.batch_max_gap = batch_max_gap
+    exporter.mpv_cwd = tmp_dir
+    exporter.migaku_anki_port = addon.server_address[1]
+
+    results = {}
+
+    try:
+        def export_card():
+            exporter.export_card(media_file, 1, 'テスト', 'Test', 10.0, 12.0, ['テスト'], 0, 1, time.time())
+
+        # First export also connects and fetches the media path
+        results['export_card_first'] = common.measure(export_card, 1)
+        results['export_card'] = common.measure(export_card, repeat)
+
+        cards = [dict(card, start=card['start'] / 1000.0, end=card['end'] / 1000.0) for card in make_cards(mass_export_size)]
+        results['export_cards'] = common.measure(lambda: exporter.export_cards(media_file, 1, cards), max(1, repeat // 5))
+
+        # Whole path from the browser request, progress is reported to the fake mpv
+        migaku_mpv.mpv = MpvIpc(ipc_server.path)
+        migaku_mpv.anki_exporter = exporter
+        migaku_mpv.media_path = media_file
+        migaku_mpv.audio_track = 1
+
+        single_request = json.dumps(make_cards(1)).encode()
+        results['post_handler_anki'] = common.measure(lambda: migaku_mpv.post_handler_anki(common.NullSocket(), single_request), repeat)
+
+        migaku_mpv.mpv.close()
+    finally:
+        addon.shutdown()
+        ipc_server.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'benchmark': 'export_card',
+        'repeat': repeat,
+        'mass_export_size': mass_export_size,
+        'real_ffmpeg': ffmpeg is not None,
+        'batch_max_gap': exporter.batch_max_gap,
+        'cards_received': addon.card_count,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports cards to a fake Migaku add-on with a stub ffmpeg')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--mass-export-size', type=int, default=50, help='Cards per mass export')
+    parser.add_argument('--ffmpeg', help='Real ffmpeg executable to use instead of the stub')
+    parser.add_argument('--media', help='Media file to export from, needed with --ffmpeg')
+    parser.add_argument('--batch-max-gap', type=float, help='Overrides the mass export batch gap (seconds)')
+    args = parser.parse_args()
+
+    if args.ffmpeg and not args.media:
+        parser.error('--ffmpeg requires --media')
+
+    with common.log_to_stderr():
+        result = run(args.repeat, args.mass_export_size, args.ffmpeg, args.media, args.batch_max_gap)
+
+    common.print_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from utils.mpv_ipc import MpvIpc_Base
+
+
+recording_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mpv_ipc_stream.jsonl')
+
+
+# Replays recorded IPC data in chunks like a busy socket would deliver them
+class ReplayIpc(MpvIpc_Base):
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.pos = 0
+        super().__init__(None)
+
+    def port_open(self, ipc_handle_path):
+        pass
+
+    def port_read(self, readlen):
+        n = min(readlen, self.chunk_size)
+        ret = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return ret
+
+
+# Framing as it was before, kept for comparison
+def listen_concat(ipc):
+    data = b''
+    while True:
+        new_data = ipc.port_read(1024)
+        if new_data == b'':
+            break
+        data += new_data
+        if data[-1] != 10:
+            continue
+        utf8_data = data.decode('utf-8', errors='ignore')
+        for line in utf8_data.split('\n'):
+            if line != '':
+                yield json.loads(line)
+        data = b''
+
+
+def run(repeat, chunk_size):
+    with open(recording_path, 'rb') as f:
+        recording = f.read()
+
+    data = recording * repeat
+    lines = data.count(b'\n')
+
+    results = {}
+
+    for name, listen in [('listen', lambda ipc: ipc.listen()), ('listen_concat', listen_concat)]:
+        ipc = ReplayIpc(data, chunk_size)
+        t = time.perf_counter()
+        count = sum(1 for _ in listen(ipc))
+        elapsed = time.perf_counter() - t
+        assert count == lines
+        results[name] = {
+            'seconds': elapsed,
+            'lines_per_second': lines / elapsed,
+        }
+
+    return {
+        'benchmark': 'ipc_listen',
+        'bytes': len(data),
+        'lines': lines,
+        'chunk_size': chunk_size,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a recorded mpv IPC stream through MpvIpc.listen')
+    parser.add_argument('--repeat', type=int, default=2000, help='How often the recording is repeated')
+    parser.add_argument('--chunk-size', type=int, default=65536, help='Bytes returned per read')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.repeat, args.chunk_size), indent=4))
+
+
+if __name__ == '__main__':
+    main()
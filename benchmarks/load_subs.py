@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import argparse
+
+import common
+
+import migaku_mpv
+from utils.filecache import FileCache
+
+
+encodings = ['utf-8', 'utf-8-sig', 'utf-16', 'shift_jis', 'cp1252']
+
+generators = {
+    'srt': common.make_srt,
+    'ass': common.make_ass,
+}
+
+
+def clear_memo():
+    with migaku_mpv.parsed_subs_memo_lock:
+        migaku_mpv.parsed_subs_memo.clear()
+
+
+def run(sizes, formats, repeat):
+    tmp_dir = common.make_temp_dir()
+    results = []
+
+    try:
+        for size in sizes:
+            for fmt in formats:
+                for encoding in encodings:
+                    # Japanese text can't be represented in cp1252
+                    text = generators[fmt](size, ascii_only=(encoding == 'cp1252'))
+                    path = os.path.join(tmp_dir, 'subs_%d_%s.%s' % (size, encoding, fmt))
+                    with open(path, 'w', encoding=encoding, newline='\n') as f:
+                        f.write(text)
+
+                    result = {
+                        'lines': size,
+                        'format': fmt,
+                        'encoding': encoding,
+                        'file_bytes': os.path.getsize(path),
+                    }
+
+                    # Encoding detection and parsing with pysubs2
+                    migaku_mpv.subs_cache = None
+                    def load_uncached():
+                        clear_memo()
+                        migaku_mpv.load_subs_from_info(path)
+                    result['parse'] = common.measure(load_uncached, repeat)
+
+                    # Parsed list read back from the disk cache
+                    cache_dir = os.path.join(tmp_dir, 'cache')
+                    migaku_mpv.subs_cache = FileCache(cache_dir)
+                    load_uncached()
+                    result['disk_cache'] = common.measure(load_uncached, repeat)
+
+                    # Parsed list still in memory, e.g. after pre-parsing
+                    subs = migaku_mpv.load_subs_from_info(path)
+                    result['memory'] = common.measure(lambda: migaku_mpv.load_subs_from_info(path), repeat)
+
+                    result['json_dumps'] = common.measure(lambda: json.dumps(subs), repeat)
+                    result['json_bytes'] = len(json.dumps(subs).encode())
+
+                    migaku_mpv.subs_cache = None
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                    clear_memo()
+
+                    results.append(result)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'benchmark': 'load_subs',
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loads synthetic subtitle files through load_subs_from_info')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='Subtitle line counts')
+    parser.add_argument('--formats', nargs='+', default=list(generators), choices=list(generators))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with common.log_to_stderr():
+        result = run(args.sizes, args.formats, args.repeat)
+
+    common.print_result(result)
+
+
+if __name__ == '__main__':
+    main()
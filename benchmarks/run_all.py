@@ -0,0 +1,62 @@
+import sys
+import json
+import argparse
+
+import common
+
+import ipc_listen
+import load_subs
+import set_subs
+import sse_fanout
+import export_card
+
+
+# Quick settings keep a full run at a few minutes, --full uses the defaults of the single benchmarks
+quick_settings = {
+    'ipc_listen':   lambda: ipc_listen.run(500, 65536),
+    'load_subs':    lambda: load_subs.run([1000, 10000], list(load_subs.generators), 3),
+    'set_subs':     lambda: set_subs.run([1000, 10000], 3),
+    'sse_fanout':   lambda: sse_fanout.run([1, 10, 50], 100, 0.002, 500),
+    'export_card':  lambda: export_card.run(10, 20),
+}
+
+full_settings = {
+    'ipc_listen':   lambda: ipc_listen.run(2000, 65536),
+    'load_subs':    lambda: load_subs.run([1000, 10000, 50000], list(load_subs.generators), 3),
+    'set_subs':     lambda: set_subs.run([1000, 10000], 5),
+    'sse_fanout':   lambda: sse_fanout.run([1, 10, 50, 100], 200, 0.002, 1000),
+    'export_card':  lambda: export_card.run(20, 50),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs all benchmarks and writes the results as one json document')
+    parser.add_argument('--full', action='store_true', help='Larger inputs and more runs')
+    parser.add_argument('--only', nargs='+', choices=list(quick_settings), help='Benchmarks to run')
+    parser.add_argument('--output', help='Result file, printed to stdout if not set')
+    args = parser.parse_args()
+
+    settings = full_settings if args.full else quick_settings
+
+    results = {
+        'environment': common.environment(),
+        'full': args.full,
+        'benchmarks': {},
+    }
+
+    for name, run in settings.items():
+        if args.only and name not in args.only:
+            continue
+        print('Running %s...' % name, file=sys.stderr)
+        with common.log_to_stderr():
+            results['benchmarks'][name] = run()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4, ensure_ascii=False)
+    else:
+        common.print_result(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import threading
+
+import common
+
+import migaku_mpv
+from utils.filecache import FileCache
+from utils.rubysubs_worker import RubysubsWorker
+
+
+# Stands in for the mpv connection, signals when styled subs are added
+class FakeMpv():
+
+    def __init__(self):
+        self.sub_added = threading.Event()
+
+    def get_properties(self, names, default=None, timeout=5.0):
+        return { 'video-params/w': 1920, 'video-params/h': 1080 }
+
+    def command(self, command, *args):
+        if command == 'sub-add':
+            self.sub_added.set()
+
+    def show_text(self, text, duration=4.0):
+        pass
+
+
+def make_request(size):
+    subs = []
+    for i in range(size):
+        start = i * 2000
+        subs.append([start, start + 1800, common.sub_text(i)])
+    return json.dumps({ 'parser': 'ja', 'parser_args': [], 'subs': subs }).encode()
+
+
+def run(sizes, repeat):
+    tmp_dir = common.make_temp_dir()
+    results = []
+
+    fake_mpv = FakeMpv()
+    migaku_mpv.mpv = fake_mpv
+    migaku_mpv.tmp_dir = tmp_dir
+
+    stub_rubysubs = common.write_script(tmp_dir, 'rubysubs', common.stub_rubysubs_source)
+    stub_worker = common.write_script(tmp_dir, 'rubysubs_worker', common.stub_rubysubs_worker_source)
+
+    # Scripts can only be executed directly on posix systems
+    modes = ['worker', 'cached']
+    if os.name == 'posix':
+        modes.insert(0, 'subprocess')
+
+    def set_subs(data):
+        fake_mpv.sub_added.clear()
+        migaku_mpv.post_handler_set_subs(common.NullSocket(), data)
+        if not fake_mpv.sub_added.wait(120.0):
+            raise RuntimeError('Styled subs were not added')
+
+    try:
+        for size in sizes:
+            data = make_request(size)
+
+            for mode in modes:
+                migaku_mpv.rubysubs = stub_rubysubs
+                migaku_mpv.rubysubs_worker = None
+                migaku_mpv.styled_cache = None
+
+                if mode == 'worker':
+                    migaku_mpv.rubysubs_worker = RubysubsWorker([sys.executable, stub_worker])
+                    set_subs(data)      # Starts the worker
+                elif mode == 'cached':
+                    migaku_mpv.styled_cache = FileCache(os.path.join(tmp_dir, 'styled'))
+                    set_subs(data)      # Fills the cache
+
+                results.append({
+                    'lines': size,
+                    'mode': mode,
+                    'request_bytes': len(data),
+                    'set_subs': common.measure(lambda: set_subs(data), repeat),
+                })
+
+                if migaku_mpv.rubysubs_worker is not None:
+                    migaku_mpv.rubysubs_worker.close()
+                    migaku_mpv.rubysubs_worker = None
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {
+        'benchmark': 'set_subs',
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Styles synthetic subtitles through post_handler_set_subs with a stub rubysubs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with common.log_to_stderr():
+        result = run(args.sizes, args.repeat)
+
+    common.print_result(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import time
+import socket
+import argparse
+import threading
+
+import common
+
+from utils.server import HttpServer
+
+
+# Reads an event stream and records when each message arrived
+class StreamClient():
+
+    def __init__(self, port):
+        self.arrivals = {}
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.sendall(b'GET /data HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        buffer = b''
+        headers_done = False
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            now = time.perf_counter()
+            buffer += data
+            if not headers_done:
+                if b'\r\n\r\n' not in buffer:
+                    continue
+                buffer = buffer.split(b'\r\n\r\n', 1)[1]
+                headers_done = True
+            *events, buffer = buffer.split(b'\r\n\r\n')
+            for event in events:
+                if event.startswith(b'data: '):
+                    self.arrivals[int(event[6:])] = now
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+def wait_for(condition, timeout=10.0):
+    end = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > end:
+            raise RuntimeError('Timed out')
+        time.sleep(0.001)
+
+
+def run(client_counts, messages, interval, burst):
+    results = []
+
+    server = HttpServer('127.0.0.1', range(43000, 43100))
+    server.set_event_stream('/data')
+    server.open()
+
+    try:
+        for client_count in client_counts:
+            clients = [StreamClient(server.port) for _ in range(client_count)]
+            wait_for(lambda: len(server.get_event_clients('/data')) == client_count)
+
+            # Latency of single messages, sent with a pause like subtitle changes
+            send_times = {}
+            for seq in range(messages):
+                send_times[seq] = time.perf_counter()
+                server.send_event('/data', str(seq))
+                time.sleep(interval)
+
+            last = messages - 1
+            wait_for(lambda: all(last in c.arrivals for c in clients))
+
+            latencies = []
+            for seq, send_time in send_times.items():
+                arrivals = [c.arrivals[seq] for c in clients if seq in c.arrivals]
+                if len(arrivals) == client_count:
+                    latencies.append(max(arrivals) - send_time)
+
+            # Burst of messages without pause, only the last one has to arrive everywhere
+            burst_start = time.perf_counter()
+            for seq in range(messages, messages + burst):
+                server.send_event('/data', str(seq))
+            last = messages + burst - 1
+            wait_for(lambda: all(last in c.arrivals for c in clients))
+            burst_time = max(c.arrivals[last] for c in clients) - burst_start
+
+            results.append({
+                'clients': client_count,
+                'messages': messages,
+                'delivered_to_all': len(latencies),
+                'latency': common.stats(latencies),
+                'burst_messages': burst,
+                'burst_seconds': burst_time,
+            })
+
+            for c in clients:
+                c.close()
+            wait_for(lambda: len(server.get_event_clients('/data')) == 0)
+    finally:
+        server.close()
+
+    return {
+        'benchmark': 'sse_fanout',
+        'interval': interval,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures delivery of server-sent events to many clients')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--messages', type=int, default=200, help='Single messages per client count')
+    parser.add_argument('--interval', type=float, default=0.002, help='Seconds between single messages')
+    parser.add_argument('--burst', type=int, default=1000, help='Messages sent at once')
+    args = parser.parse_args()
+
+    with common.log_to_stderr():
+        result = run(args.clients, args.messages, args.interval, args.burst)
+
+    common.print_result(result)
+
+
+if __name__ == '__main__':
+    main()
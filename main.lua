@@ -1,5 +1,4 @@
 mp.utils = require("mp.utils") -- Required for selene to work properly
-local utils = mp.utils
 local SelectionMenu = require('modules.selectionmenu')
 
 function trim(s)
@@ -118,24 +117,6 @@ local function get_active_subtitle_track_path(secondary, only_external)
 end
 
 
-local function get_active_audio_tack()
-    local tracks_count = mp.get_property_number('track-list/count')
-
-    for i = 0, (tracks_count - 1) do
-        local track_type = mp.get_property(string.format('track-list/%d/type', i))
-        local track_selected = mp.get_property(string.format('track-list/%d/selected', i))
-        local track_id = mp.get_property(string.format('track-list/%d/id', i))
-        local track_ext_path = mp.get_property(string.format('track-list/%d/external-filename', i))
-
-        if track_type == 'audio' and track_selected == 'yes' and track_id and track_ext_path == nil then
-            return track_id
-        end
-    end
-
-    return '-1'
-end
-
-
 local function is_sub_codec_supported(codec)
     local supported = { 'subrip', 'ass' }
     for _, v in pairs(supported) do
@@ -368,41 +349,8 @@ end
 
 
 local function on_migaku_open()
-    -- get subtitle path
-    local sub_path = get_active_subtitle_track_path(false)
-    if sub_path == nil then
-        sub_path = ''
-    end
-
-    -- get secondary subtitle path
-    local secondary_sub_path = get_active_subtitle_track_path(true)
-    if secondary_sub_path == nil then
-        secondary_sub_path = ''
-    end
-
-    -- get playing file
-    local file_name = mp.get_property('path')
-    if file_name == nil or file_name == '' then
-        return
-    end
-
-    -- get current audio track (only supports internal audio)
-    local audio_track = get_active_audio_tack()
-
-    -- get sub delay
-    local sub_delay = mp.get_property('sub-delay')
-
-    -- get media resolution
-    local resx = mp.get_property('video-params/w')
-    local resy = mp.get_property('video-params/h')
-
-    -- get mpv cwd
-    local cwd = utils.getcwd()
-
-    -- get mpv pid
-    local pid = utils.getpid()
-
-    mp.commandv('script-message', '@migaku', 'open', cwd, pid, file_name, audio_track, sub_path, secondary_sub_path, sub_delay, resx, resy)
+    -- The script requests all info about the playing environment it needs
+    mp.commandv('script-message', '@migaku', 'open')
 end
 
 
@@ -477,6 +425,12 @@ local function get_auto_secondary_sid()
 end
 
 
+local function on_tracks_changed()
+    -- Lets the script parse the active subtitles ahead of opening
+    mp.commandv('script-message', '@migaku', 'tracks-changed')
+end
+
+
 local function on_loaded()
     local secondary_sid = get_auto_secondary_sid()
     if secondary_sid ~= nil then
@@ -491,6 +445,9 @@ mp.observe_property('time-pos', 'number', on_time_pos_change)
 mp.observe_property('pause', 'bool', on_pause_change)
 mp.observe_property('mouse-pos', 'native', on_mouse_move)
 mp.register_event('file-loaded', on_loaded)
+mp.register_event('file-loaded', on_tracks_changed)
+mp.observe_property('sid', 'native', on_tracks_changed)
+mp.observe_property('secondary-sid', 'native', on_tracks_changed)
 mp.register_script_message('@migakulua', on_script_message)
 mp.add_key_binding('b', 'migaku-open', on_migaku_open)
 mp.add_key_binding('B', 'migaku-resync', on_migaku_resync)
@@ -1,27 +1,31 @@
+import time
+startup_time = time.perf_counter()          # Reference for the startup timings in the log
+
 import sys
 import os
-import time
+import re
 import shutil
-import queue
 import json
 import subprocess
 import collections
-import psutil
 import pathlib
-import webbrowser
 import threading
 import traceback
 import platform
-import pysubs2
 import codecs
-import cchardet as chardet
-import requests
 import urllib.parse
-import urllib.request
+import importlib.util
+
+# pysubs2, cchardet, requests, psutil, webbrowser and urllib.request are imported where they are first used.
+# They are slow to import and not needed before the browser is opened.
 
 from utils.mpv_ipc import MpvIpc
-from utils.server import HttpServer, HttpResponse
+from utils.server import HttpServer, HttpResponse, CachedContent
 from utils.ankiexport import AnkiExporter
+from utils.filecache import FileCache
+from utils.subindex import SubtitleIndex
+from utils.rubysubs_worker import RubysubsWorker, RubysubsWorkerError
+import utils.metrics as metrics
 import utils.browser_support as browser_support
 
 
@@ -35,6 +39,7 @@ else:
     plugin_dir = os.path.dirname(os.path.abspath(__file__))
 plugin_dir_name = os.path.basename(plugin_dir)
 tmp_dir = os.path.join(plugin_dir, 'tmp')
+cache_dir = os.path.join(plugin_dir, 'cache')
 
 
 mpv = None
@@ -44,21 +49,52 @@ port = None
 
 media_path = None
 audio_track = None
-resx = 1920
-resy = 1080
 sub_font_name = 'Noto Sans CJK JP Regular'
 sub_font_size = 55
 sub_bottom_margin = 22
 sub_outline_size = 3
 sub_shadow_offset = 0
-subs_json = '[]'
-secondary_subs_json = '[]'
+subs_content = CachedContent(b'[]', 'application/json')
+secondary_subs_content = CachedContent(b'[]', 'application/json')
+subs_page_size = 200                            # Same as in the frontend, windows of whole pages are encoded once
+subs_page_contents = []
+subs_index = SubtitleIndex([])
+secondary_subs_index = SubtitleIndex([])
+loaded_subs = []
+loaded_secondary_subs = []
+current_sub_ids = []
 subs_delay = 0
 
 anki_exporter = AnkiExporter()
 
-data_queues = []
-data_queues_lock = threading.Lock()
+subs_cache = None
+track_cache = None
+styled_cache = None
+websubs_cache = None
+
+websubs_session = None                          # Shared so connections are reused across opens
+websubs_lock = threading.Lock()                 # Sessions are not thread safe, downloads are serialized
+websubs_timeout = 15.0
+websubs_max_size = 16 * 1024 * 1024             # Larger downloads are aborted
+websubs_downloads = metrics.registry.counter('migaku_websub_downloads_total',
+                                             'Web subtitle requests by result: downloaded, not_modified, offline or failed',
+                                             ('result',))
+
+parsed_subs_memo = collections.OrderedDict()     # Recently parsed subs by file identity, least recently used first
+parsed_subs_memo_size = 4
+parsed_subs_memo_lock = threading.Lock()
+internal_subs_export_lock = threading.Lock()
+encoding_sample_size = 64 * 1024               # Initial number of bytes passed to chardet
+encoding_min_confidence = 0.8                   # Below the sample is enlarged
+internal_sub_stream_regex = re.compile(r'Stream #0:(\d+)(?:\[\w+\])?(?:\(\w+\))?: Subtitle: (\w+)')
+
+server = None
+
+ipc_command_duration = metrics.registry.histogram('migaku_mpv_command_duration_seconds',
+                                                  'Time the IPC loop spent handling script messages',
+                                                  ('command',))
+
+open_lock = threading.Lock()
 
 last_subs_request = 0
 
@@ -69,9 +105,11 @@ reuse_last_tab_timeout = 1.5
 ffmpeg = 'ffmpeg'
 ffsubsync = 'ffsubsync'
 rubysubs = 'rubysubs'
+rubysubs_worker = None
 mpv_external = None
 skip_empty_subs = True
 subtitle_export_timeout = 0
+extract_all_subtitle_tracks = True
 
 log_file = None
 
@@ -79,6 +117,7 @@ log_file = None
 def path_clean(path):
 
     if path.startswith('file:'):
+        import urllib.request
         uri_path = urllib.parse.urlparse(path).path
         return urllib.request.url2pathname(uri_path)
 
@@ -87,65 +126,93 @@ def path_clean(path):
 
 ### Handlers for GET requests
 
-def get_handler_subs(socket):
+def get_handler_subs(socket, request):
 
     global last_subs_request
     last_subs_request = time.time()
 
-    r = HttpResponse(content=subs_json.encode(), content_type='text/html')
-    r.send(socket)
+    # Lookups are ordered by start, the latest starting sub is the one that was just reached
+    current_id = current_sub_ids[-1] if current_sub_ids else None
 
+    send_subs(socket, request, loaded_subs, subs_content, subs_page_contents, subs_index, current_id)
 
-def get_handler_secondary_subs(socket):
+
+def get_handler_secondary_subs(socket, request):
 
     global last_subs_request
     last_subs_request = time.time()
 
-    r = HttpResponse(content=secondary_subs_json.encode(), content_type='text/html')
-    r.send(socket)
+    send_subs(socket, request, loaded_secondary_subs, secondary_subs_content, [], secondary_subs_index)
 
 
-def get_handler_data(socket):
+# Windows of whole pages as sent by send_subs, encoded and compressed once per loaded subs
+def make_subs_page_contents(subs):
 
-    r = HttpResponse(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
-    r.send(socket)
+    contents = []
+
+    for range_from in range(0, len(subs), subs_page_size):
+        range_to = min(range_from + subs_page_size, len(subs))
+        contents.append(make_subs_window_content(subs, range_from, range_to))
+
+    return contents
 
-    q = queue.Queue()
 
-    data_queues_lock.acquire()
-    data_queues.append(q)
-    data_queues_lock.release()
+def make_subs_window_content(subs, range_from, range_to):
 
-    keep_listening = True
-    while keep_listening:
-        data = q.get()
+    window = {
+        'total': len(subs),
+        'from': range_from,
+        'to': range_to,
+        'subs': subs[range_from:range_to],
+    }
 
-        if len(data) < 1:
-            keep_listening = False
+    return CachedContent(json.dumps(window).encode(), 'application/json')
+
+
+# Without query the full list is sent. Otherwise only a window of it, either by
+# position (?from=&to=, to is exclusive) or by time in ms (?start=&end=),
+# together with the total count so the frontend can fetch the rest lazily.
+# The current sub changes independently of the cached windows and is sent in a header.
+def send_subs(socket, request, subs, content, page_contents, index, current_id=None):
+
+    if not request.query:
+        content.send(socket, request)
+        return
+
+    try:
+        if 'start' in request.query or 'end' in request.query:
+            window_start = int(request.query.get('start', 0))
+            window_end = int(request.query.get('end', sys.maxsize))
+            ids = index.overlapping(window_start, window_end)
+            range_from = min(ids, default=0)
+            range_to = max(ids, default=-1) + 1
         else:
-            cmd = data[0]
+            range_from = int(request.query.get('from', 0))
+            range_to = int(request.query.get('to', len(subs)))
+    except ValueError:
+        r = HttpResponse(code=400)
+        r.send(socket)
+        return
 
-            if cmd in ['s', 'r', 'e', 'l']:
-                send_msg = 'data: ' + data + '\r\n\r\n'
-                try:
-                    socket.sendall(send_msg.encode())
-                except:
-                    keep_listening = False
-            else:
-                keep_listening = False
+    range_from = max(0, min(range_from, len(subs)))
+    range_to = max(range_from, min(range_to, len(subs)))
 
-        q.task_done()
+    page, page_offset = divmod(range_from, subs_page_size)
+    if page_offset == 0 and page < len(page_contents) and range_to == min(range_from + subs_page_size, len(subs)):
+        window_content = page_contents[page]
+    else:
+        window_content = make_subs_window_content(subs, range_from, range_to)
 
-    data_queues_lock.acquire()
-    data_queues.remove(q)
-    data_queues_lock.release()
+    headers = { 'X-Current-Sub': '' if current_id is None else str(current_id) }
+    window_content.send(socket, request, headers)
 
 
 ### Handlers for POST requests
 
 def post_handler_anki(socket, data):
 
-    r = HttpResponse()
+    # Work continues after responding, don't let the browser reuse this connection meanwhile
+    r = HttpResponse(headers={'Connection': 'close'})
     r.send(socket)
 
     if audio_track < 0:
@@ -158,24 +225,27 @@ def post_handler_anki(socket, data):
 
     is_mass_export = len(cards) > 1
 
-    timestamp = time.time()
+    export_cards = []
 
-    for i, card in enumerate(cards):
-        text = card['text']
-        translation_text = card['translation_text']
-        unknowns = card['unknowns']
-        # ms to seconds
-        start = card['start'] / 1000.0
-        end = card['end'] / 1000.0
-
-        try:
-            anki_exporter.export_card(media_path, audio_track, text, translation_text, start, end, unknowns, i, len(cards), timestamp)
-        except AnkiExporter.ExportError as e:
-            mpv.show_text('Exporting card failed:\n\n' + str(e), 8.0)
-            return
+    for card in cards:
+        export_cards.append({
+            'text':             card['text'],
+            'translation_text': card['translation_text'],
+            'unknowns':         card['unknowns'],
+            # ms to seconds
+            'start':            card['start'] / 1000.0,
+            'end':              card['end'] / 1000.0,
+        })
 
+    def on_progress(done_count, count):
         if is_mass_export:
-            mpv.show_text('%d/%d' % (i+1, len(cards)), 10.0)
+            mpv.show_text('%d/%d' % (done_count, count), 10.0)
+
+    try:
+        anki_exporter.export_cards(media_path, audio_track, export_cards, on_progress)
+    except AnkiExporter.ExportError as e:
+        mpv.show_text('Exporting card failed:\n\n' + str(e), 8.0)
+        return
 
     if is_mass_export:
         mpv.show_text('Card export finished.')
@@ -190,7 +260,6 @@ def post_handler_mpv_control(socket, data):
 
 
 def post_handler_set_subs(socket, data):
-    global subs_delay
 
     r = HttpResponse()
     r.send(socket)
@@ -200,9 +269,94 @@ def post_handler_set_subs(socket, data):
         return
 
     if data:
+        submit_styling_job(json.loads(data))
+
+
+### Subtitle styling jobs
+# Only the result of the latest request matters. Requests that were not
+# started yet are replaced and running jobs stop at the next check.
+
+styling_condition = threading.Condition()
+styling_pending = None          # (generation, request data) of the latest request that was not started yet
+styling_generation = 0          # Increased with each request
+styling_thread = None
+
+
+class StylingSuperseded(Exception):
+    pass
+
+
+def submit_styling_job(json_data):
+    global styling_pending
+    global styling_generation
+    global styling_thread
+
+    with styling_condition:
+        styling_generation += 1
+        styling_pending = (styling_generation, json_data)
+
+        if styling_thread is None:
+            styling_thread = threading.Thread(target=styling_thread_func, daemon=True)
+            styling_thread.start()
+
+        styling_condition.notify()
+
+
+def check_styling_superseded(generation):
+
+    if generation != styling_generation:
+        raise StylingSuperseded()
+
+
+def styling_thread_func():
+    global styling_pending
+
+    while True:
+        with styling_condition:
+            while styling_pending is None:
+                styling_condition.wait()
+            generation, json_data = styling_pending
+            styling_pending = None
+
+        # The thread serves all later requests, so failed jobs must not end it
+        try:
+            run_styling_job(generation, json_data)
+        except StylingSuperseded:
+            print('SUBS: Styling job %d superseded' % generation)
+        except Exception:
+            print('SUBS: Styling job %d failed:' % generation)
+            print(traceback.format_exc())
+            mpv.show_text('Styling subtitles failed.')
+
+
+def run_styling_job(generation, json_data):
+    import pysubs2
+
+    check_styling_superseded(generation)
+
+    resx, resy = get_video_resolution()
+
+    # Identical requests (e.g. toggling sub modes back and forth) reuse the styled file
+    style_settings = [sub_font_name, sub_font_size, sub_bottom_margin, sub_outline_size, sub_shadow_offset]
+    cache_key = 'migaku_parsed_' + FileCache.make_key('styled', json_data['subs'], json_data['parser'], json_data['parser_args'], resx, resy, style_settings)
+
+    if styled_cache:
+        path = styled_cache.get(cache_key, '.ass')
+        if path:
+            check_styling_superseded(generation)
+            print('SUBS: Styled subtitles loaded from cache')
+            apply_styled_subs(path)
+            # Also replaces the progress message of a superseded job
+            mpv.show_text('Subtitles styled')
+            return
+        path = styled_cache.temp_path('.ass')
+    else:
         path = os.path.join(tmp_dir, 'migaku_parsed_%d.ass' % round(time.time() * 1000))
-        json_data = json.loads(data)
 
+    # Removed unless it was committed to the cache or added to mpv, also when the job is superseded
+    temp_path = path
+
+    try:
         subs = pysubs2.SSAFile()
 
         subs.info = {
@@ -259,62 +413,88 @@ def post_handler_set_subs(socket, data):
 
         subs.save(path)
 
-        r = subprocess.run([rubysubs, path, path, json_data['parser'], *json_data['parser_args']])
-        if r.returncode == 0:
-            mpv.command('sub-add', path)
-            mpv.command('set_property', 'sub-delay', 0)
-            subs_delay = 0
-            mpv.command('script-message', '@migakulua', 'remove_inactive_parsed_subs')
+        check_styling_superseded(generation)
+
+        mpv.show_text('Styling subtitles...', 60.0)
+        style_start = time.time()
+
+        # A newer request doesn't interrupt rubysubs, the result is still cached for later
+        if run_rubysubs(path, json_data['parser'], json_data['parser_args']):
+            if styled_cache:
+                path = styled_cache.commit(cache_key, '.ass', path)
+                temp_path = None
+            check_styling_superseded(generation)
+            apply_styled_subs(path)
+            temp_path = None
+            style_time = time.time() - style_start
+            print('SUBS: Styled subtitles in %.2fs' % style_time)
+            mpv.show_text('Subtitles styled (%.1fs)' % style_time)
         else:
             mpv.show_text('Styling subtitles failed.')
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
 
 
+# Styles the file in place, preferring the persistent worker over a new process per call
+def run_rubysubs(path, parser, parser_args):
 
-### Managing data streams
+    if rubysubs_worker is not None:
+        start = time.perf_counter()
+        try:
+            rubysubs_worker.convert(path, path, parser, parser_args)
+            metrics.observe_process('rubysubs_worker', time.perf_counter() - start, 0)
+            return True
+        except RubysubsWorkerError as e:
+            metrics.observe_process('rubysubs_worker', time.perf_counter() - start, 'error')
+            print('RUBYSUBS: Worker failed, running rubysubs directly:', e)
 
-def stop_get_data_handlers():
+    r = metrics.run_process('rubysubs', [rubysubs, path, path, parser, *parser_args])
+    return r.returncode == 0
 
-    data_queues_lock.acquire()
 
-    for q in data_queues:
-        q.put('q')
+def apply_styled_subs(path):
+    global subs_delay
+
+    mpv.command('sub-add', path)
+    mpv.command('set_property', 'sub-delay', 0)
+    subs_delay = 0
+    mpv.command('script-message', '@migakulua', 'remove_inactive_parsed_subs')
 
-    data_queues_lock.release()
 
 
+### Managing data streams
+
 def send_subtitle_time(arg):
+    global current_sub_ids
 
     time_millis = (int(round(float(arg) * 1000)) + subs_delay) // 10 * 10
 
-    data_queues_lock.acquire()
-
-    for q in data_queues:
-        q.put('s' + str(time_millis))
+    sub_ids = subs_index.lookup(time_millis)
+    if not sub_ids:
+        return
+    current_sub_ids = sub_ids
 
-    data_queues_lock.release()
+    # Only the latest position matters, undelivered older ones are replaced
+    server.send_event('/data', 'i' + ','.join(str(i) for i in sub_ids), coalesce_key='i')
 
 
 def browser_export_current():
 
-    data_queues_lock.acquire()
-
-    for q in data_queues:
-        q.put('e')
-
-    data_queues_lock.release()
+    server.send_event('/data', 'e')
 
 
 def browser_lookup_current():
 
-    data_queues_lock.acquire()
-
-    for q in data_queues:
-        q.put('l')
-
-    data_queues_lock.release()
+    server.send_event('/data', 'l')
 
 
 def open_webbrowser_new_tab():
+    import webbrowser
+
     url = 'http://' + str(host) + ':' + str(port)
 
     try:
@@ -337,35 +517,263 @@ class SubtitleLoadError(Exception):
     pass
 
 
+# Lists all text subtitle streams of the media file as [(ffmpeg_track, sub_extension), ...]
+def probe_internal_subs(source_path):
+
+    args = [ffmpeg, '-hide_banner', '-i', source_path]
+    try:
+        timeout = subtitle_export_timeout if subtitle_export_timeout > 0 else None
+        r = metrics.run_process('ffmpeg', args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+    except Exception:
+        return []
+
+    streams = []
+    stream_info = r.stderr.decode('utf-8', errors='ignore')
+
+    for match in internal_sub_stream_regex.finditer(stream_info):
+        ffmpeg_track, sub_codec = match.groups()
+        if sub_codec == 'subrip':
+            streams.append((ffmpeg_track, 'srt'))
+        elif sub_codec == 'ass':
+            streams.append((ffmpeg_track, 'ass'))
+
+    return streams
+
+
+# Exports an internal subtitle track with ffmpeg
+# Exported tracks are cached on disk, keyed by media identity and track index
+# If enabled all text subtitle tracks are exported in one pass when the first one is requested
+def export_internal_subs(source_path, ffmpeg_track, sub_extension, quiet=False):
+
+    try:
+        media_identity = FileCache.file_identity(source_path)
+    except OSError:
+        media_identity = None   # Not a local file
+
+    use_cache = media_identity is not None and track_cache is not None
+
+    def cache_key_for(track):
+        return FileCache.make_key('track', media_identity, track)
+
+    if use_cache:
+        cached_path = track_cache.get(cache_key_for(ffmpeg_track), '.' + sub_extension)
+        if cached_path:
+            print('SUBS: Using cached internal subtitle track:', cached_path)
+            return cached_path
+
+    with internal_subs_export_lock:
+
+        # Another export might have finished while waiting
+        if use_cache:
+            cached_path = track_cache.get(cache_key_for(ffmpeg_track), '.' + sub_extension)
+            if cached_path:
+                return cached_path
+
+        if not quiet:
+            mpv.show_text('Exporting internal subtitle track...', duration=150.0)    # Next osd message will close it
+
+        export_tracks = [(ffmpeg_track, sub_extension)]
+        if use_cache and extract_all_subtitle_tracks:
+            all_tracks = probe_internal_subs(source_path)
+            if (ffmpeg_track, sub_extension) in all_tracks:
+                export_tracks = all_tracks
+
+        if not use_cache:
+            cache_key_for = None
+
+        sub_path = export_internal_subs_run(source_path, ffmpeg_track, export_tracks, cache_key_for)
+
+        # One broken stream fails the whole run, the requested track alone might still work
+        if sub_path is None and len(export_tracks) > 1:
+            print('SUBS: Exporting all internal subtitle tracks failed, retrying with the requested track')
+            sub_path = export_internal_subs_run(source_path, ffmpeg_track, [(ffmpeg_track, sub_extension)], cache_key_for)
+
+        if sub_path is None:
+            raise SubtitleLoadError('Exporting internal subtitle track failed.')
+
+    return sub_path
+
+
+# Runs one ffmpeg pass exporting export_tracks, returns the path of ffmpeg_track or None if it was not exported
+# Exported tracks are committed to the track cache if cache_key_for is set
+def export_internal_subs_run(source_path, ffmpeg_track, export_tracks, cache_key_for):
+
+    export_paths = []
+    args = [ffmpeg, '-y', '-loglevel', 'error', '-i', source_path]
+
+    for track, extension in export_tracks:
+        if cache_key_for:
+            path = track_cache.temp_path('.' + extension)
+        else:
+            path = os.path.join(tmp_dir, 'internal_%d_%s.%s' % (round(time.time() * 1000), track, extension))
+        export_paths.append(path)
+        args.extend(['-map', '0:' + track, path])
+
+    print('SUBS: Exporting internal subtitle tracks:', [track for track, _ in export_tracks])
+
+    try:
+        timeout = subtitle_export_timeout if subtitle_export_timeout > 0 else None
+        r = metrics.run_process('ffmpeg', args, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise SubtitleLoadError('Exporting internal subtitle track timed out.')
+    except:
+        raise SubtitleLoadError('Exporting internal subtitle track failed.')
+
+    sub_path = None
+
+    for (track, extension), path in zip(export_tracks, export_paths):
+        if not os.path.isfile(path):
+            continue
+        # Outputs of failed runs can be incomplete and are never cached
+        # With several tracks the requested one is exported again, otherwise it is used once from the temp dir
+        if r.returncode != 0:
+            if len(export_tracks) == 1:
+                uncached_path = os.path.join(tmp_dir, 'internal_%d_%s.%s' % (round(time.time() * 1000), track, extension))
+                try:
+                    os.replace(path, uncached_path)
+                    sub_path = uncached_path
+                    continue
+                except OSError:
+                    pass
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        if cache_key_for:
+            try:
+                path = track_cache.commit(cache_key_for(track), '.' + extension, path)
+            except OSError:
+                continue
+        if track == ffmpeg_track:
+            sub_path = path
+
+    return sub_path
+
+
+# Internal tracks are given as <ffmpeg track>*<codec>
+def internal_sub_path(sub_info, source_path, quiet=False):
+    sub_path = None
+
+    internal_sub_info = sub_info.split('*')
+    if len(internal_sub_info) == 2:
+        ffmpeg_track = internal_sub_info[0]
+        sub_codec = internal_sub_info[1]
+        if sub_codec in ['subrip', 'ass']:
+            if not ffmpeg:
+                raise SubtitleLoadError('Using internal subtitles requires ffmpeg to be located in the plugin directory.')
+            if sub_codec == 'subrip':
+                sub_extension = 'srt'
+            else:
+                sub_extension = sub_codec
+            sub_path = export_internal_subs(source_path, ffmpeg_track, sub_extension, quiet)
+        else:
+            raise SubtitleLoadError('Selected internal subtitle track is not supported.\n\nOnly SRT and ASS tracks are supported.\n\nSelected track is ' + sub_codec)
+
+    return sub_path
+
+
+# Downloads web subtitles into the web subtitle cache, or to the temp dir if it is disabled
+# Cached downloads are revalidated with ETag and Last-Modified and also used if the server is unreachable
+def download_web_subs(url, extension=''):
+    global websubs_session
+    import requests
+
+    with websubs_lock:
+        if websubs_session is None:
+            websubs_session = requests.Session()
+        return fetch_web_subs(websubs_session, url, extension)
+
+
+def fetch_web_subs(session, url, extension):
+    import requests
+
+    cache_key = FileCache.make_key('websub', url)
+    cached_path = None
+    request_headers = {}
+
+    if websubs_cache:
+        cached_path = websubs_cache.get(cache_key, extension)
+        try:
+            validators = json.loads(websubs_cache.read_text(cache_key, '.json') or '{}')
+        except ValueError:
+            validators = {}
+        if cached_path:
+            if validators.get('etag'):
+                request_headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                request_headers['If-Modified-Since'] = validators['last_modified']
+
+    if websubs_cache:
+        out_path = websubs_cache.temp_path(extension)
+    else:
+        out_path = os.path.join(tmp_dir, 'websub_%d%s' % (round(time.time() * 1000), extension))
+
+    try:
+        with session.get(url, headers=request_headers, stream=True, timeout=websubs_timeout) as response:
+            if response.status_code == 304 and cached_path:
+                print('SUBS: Web subtitles not modified:', url)
+                websubs_downloads.inc('not_modified')
+                return cached_path
+
+            response.raise_for_status()
+
+            content_length = response.headers.get('Content-Length', '')
+            if content_length.isdigit() and int(content_length) > websubs_max_size:
+                raise SubtitleLoadError('Web subtitles are too large.')
+
+            size = 0
+            with open(out_path, 'wb') as f:
+                for chunk in response.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size > websubs_max_size:
+                        raise SubtitleLoadError('Web subtitles are too large.')
+                    f.write(chunk)
+
+            validators = {
+                'etag':             response.headers.get('ETag'),
+                'last_modified':    response.headers.get('Last-Modified'),
+            }
+
+    except (requests.exceptions.RequestException, OSError, SubtitleLoadError) as e:
+        try:
+            os.remove(out_path)
+        except OSError:
+            pass
+
+        if isinstance(e, SubtitleLoadError):
+            websubs_downloads.inc('failed')
+            raise
+
+        if cached_path:
+            print('SUBS: Downloading web subtitles failed, using cached version:', e)
+            websubs_downloads.inc('offline')
+            return cached_path
+
+        print('SUBS: Downloading web subtitles failed:', e)
+        websubs_downloads.inc('failed')
+        raise SubtitleLoadError('Downloading web subtitles failed.')
+
+    websubs_downloads.inc('downloaded')
+
+    if not websubs_cache:
+        return out_path
+
+    try:
+        sub_path = websubs_cache.commit(cache_key, extension, out_path)
+    except OSError:
+        return out_path
+    websubs_cache.write_text(cache_key, '.json', json.dumps(validators))
+
+    return sub_path
+
+
 def load_subs_from_info(sub_info):
+
         sub_path = None
 
         if '*' in sub_info:
-            internal_sub_info = sub_info.split('*')
-            if len(internal_sub_info) == 2:
-                ffmpeg_track = internal_sub_info[0]
-                sub_codec = internal_sub_info[1]
-                if sub_codec in ['subrip', 'ass']:
-                    if not ffmpeg:
-                        raise SubtitleLoadError('Using internal subtitles requires ffmpeg to be located in the plugin directory.')
-                    mpv.show_text('Exporting internal subtitle track...', duration=150.0)    # Next osd message will close it
-                    if sub_codec == 'subrip':
-                        sub_extension = 'srt'
-                    else:
-                        sub_extension = sub_codec
-                    sub_path = tmp_dir + '/' + str(pathlib.Path(media_path).stem) + '.' + sub_extension
-                    args = [ffmpeg, '-y', '-loglevel', 'error', '-i', media_path, '-map', '0:' + ffmpeg_track, sub_path]
-                    try:
-                        timeout = subtitle_export_timeout if subtitle_export_timeout > 0 else None
-                        subprocess.run(args, timeout=timeout)
-                        if not os.path.isfile(sub_path):
-                            raise FileNotFoundError
-                    except TimeoutError:
-                        raise SubtitleLoadError('Exporting internal subtitle track timed out.')
-                    except:
-                        raise SubtitleLoadError('Exporting internal subtitle track failed.')
-                else:
-                    raise SubtitleLoadError('Selected internal subtitle track is not supported.\n\nOnly SRT and ASS tracks are supported.\n\nSelected track is ' + sub_codec)
+            sub_path = internal_sub_path(sub_info, media_path)
         else:
             sub_path = sub_info
 
@@ -380,101 +788,326 @@ def load_subs_from_info(sub_info):
         if sub_path.startswith('edl://'):
             i = sub_path.rfind('http')
             if i >= 0:
-                url = sub_path[i:]
-
-                try:
-                    response = requests.get(url)
-                    tmp_sub_path = os.path.join(tmp_dir, 'websub_%d.vtt' % round(time.time() * 1000))
-                    with open(tmp_sub_path, 'wb') as f:
-                        f.write(response.content)
-
-                    sub_path = tmp_sub_path
-                    is_websub = True
-                except Exception:
-                    raise SubtitleLoadError('Downloading web subtitles failed.')
+                sub_path = download_web_subs(sub_path[i:], '.vtt')
+                is_websub = True
 
         elif sub_path.startswith('http'):
-            try:
-                response = requests.get(sub_path)
-                tmp_sub_path = os.path.join(tmp_dir, 'websub_%d' % round(time.time() * 1000))
-                with open(tmp_sub_path, 'wb') as f:
-                    f.write(response.content)
-
-                sub_path = tmp_sub_path
-            except Exception:
-                raise SubtitleLoadError('Downloading web subtitles failed.')
+            sub_path = download_web_subs(sub_path)
 
         if not os.path.isfile(sub_path):
             print('SUBS Not found:', sub_path)
             raise SubtitleLoadError('The subtitle file "%s" was not found.' % sub_path)
 
-        # Determine subs encoding
-        subs_encoding = 'utf-8'
+        subs_list = parse_subs_file(sub_path, is_websub)
 
-        try:
-            subs_f = open(sub_path, 'rb')
-            subs_data = subs_f.read()
-            subs_f.close()
-
-            boms_for_enc = [
-                ('utf-32',      (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)),
-                ('utf-16',      (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)),
-                ('utf-8-sig',   (codecs.BOM_UTF8,)),
-            ]
-
-            for enc, boms in boms_for_enc:
-                if any(subs_data.startswith(bom) for bom in boms):
-                    subs_encoding = enc
-                    print('SUBS: Detected encoding (bom):', enc)
-                    break
+        return apply_subs_delay(subs_list, subs_delay)
+
+
+# Files without BOM are first checked to be valid utf-8, which is fast compared to chardet.
+# Otherwise chardet only gets a sample starting at the first invalid byte, since text before it
+# is plain ascii or utf-8 and does not help. The sample grows while the confidence stays low.
+def detect_subs_encoding(sub_path):
+    import cchardet as chardet
+
+    subs_encoding = 'utf-8'
+
+    try:
+        subs_f = open(sub_path, 'rb')
+        subs_data = subs_f.read()
+        subs_f.close()
+
+        boms_for_enc = [
+            ('utf-32',      (codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)),
+            ('utf-16',      (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)),
+            ('utf-8-sig',   (codecs.BOM_UTF8,)),
+        ]
+
+        for enc, boms in boms_for_enc:
+            if any(subs_data.startswith(bom) for bom in boms):
+                subs_encoding = enc
+                print('SUBS: Detected encoding (bom):', enc)
+                break
+        else:
+            # Null bytes are valid utf-8 but point to utf-16 or utf-32 without BOM
+            try:
+                if b'\0' in subs_data[:encoding_sample_size]:
+                    invalid_pos = 0
+                else:
+                    subs_data.decode('utf-8')
+                    invalid_pos = None
+            except UnicodeDecodeError as e:
+                invalid_pos = e.start
+
+            if invalid_pos is None:
+                subs_encoding = 'utf-8'
+                print('SUBS: Detected encoding (valid utf-8): utf-8')
             else:
-                chardet_ret = chardet.detect(subs_data)
+                sample_start = subs_data.rfind(b'\n', 0, invalid_pos) + 1
+                sample_size = encoding_sample_size
+
+                while True:
+                    sample_end = sample_start + sample_size
+                    chardet_ret = chardet.detect(subs_data[sample_start:sample_end])
+                    if chardet_ret['encoding'] and (chardet_ret['confidence'] or 0) >= encoding_min_confidence:
+                        break
+                    if sample_end >= len(subs_data):
+                        break
+                    sample_size *= 4
+
                 subs_encoding = chardet_ret['encoding']
-                print('SUBS: Detected encoding (chardet):', chardet_ret)
-        except:
-            print('SUBS: Detecting encoding failed. Defaulting to utf-8')
+                print('SUBS: Detected encoding (chardet, %d byte sample):' % min(sample_size, len(subs_data) - sample_start), chardet_ret)
+    except:
+        print('SUBS: Detecting encoding failed. Defaulting to utf-8')
+
+    return subs_encoding
+
+
+# Parses a subtitle file to a list of undelayed subs
+# Results are cached on disk, keyed by file identity and parse options
+def parse_subs_file(sub_path, is_websub=False):
+
+    try:
+        file_identity = FileCache.file_identity(sub_path)
+    except OSError:
+        file_identity = None
+
+    # Recently parsed files (e.g. by the background pre-parse) are kept in memory
+    memo_key = (tuple(file_identity), skip_empty_subs, is_websub) if file_identity else None
+
+    if memo_key:
+        with parsed_subs_memo_lock:
+            if memo_key in parsed_subs_memo:
+                parsed_subs_memo.move_to_end(memo_key)
+                print('SUBS: Already parsed:', sub_path)
+                return parsed_subs_memo[memo_key]
+
+    subs_list = parse_subs_file_cached(sub_path, file_identity, is_websub)
+
+    if memo_key:
+        with parsed_subs_memo_lock:
+            parsed_subs_memo[memo_key] = subs_list
+            while len(parsed_subs_memo) > parsed_subs_memo_size:
+                parsed_subs_memo.popitem(last=False)
+
+    return subs_list
+
+
+# Lists returned from here are shared, apply_subs_delay copies them
+def parse_subs_file_cached(sub_path, file_identity, is_websub):
+    import pysubs2
+
+    # Determine subs encoding, remembered per file identity
+    subs_encoding = None
+    encoding_key = FileCache.make_key('encoding', file_identity)
+
+    if file_identity and subs_cache:
+        subs_encoding = subs_cache.read_text(encoding_key, '.txt')
+
+    if not subs_encoding:
+        subs_encoding = detect_subs_encoding(sub_path)
+        if file_identity and subs_cache and subs_encoding:
+            subs_cache.write_text(encoding_key, '.txt', subs_encoding)
+
+    cache_key = FileCache.make_key('subs', file_identity, skip_empty_subs, subs_encoding, is_websub)
+
+    if file_identity and subs_cache:
+        cached_subs_json = subs_cache.read_text(cache_key, '.json')
+        if cached_subs_json is not None:
+            try:
+                subs_list = json.loads(cached_subs_json)
+                print('SUBS: Loaded from cache:', sub_path)
+                return subs_list
+            except ValueError:
+                pass
+
+    # Parse subs and generate json for frontend
+    try:
+        with open(sub_path, encoding=subs_encoding, errors='replace') as fp:
+            subs = pysubs2.SSAFile.from_file(fp)
+    except:
+        raise SubtitleLoadError('Loading subtitle file "%s" failed.' % sub_path)
+
+    subs.sort()
+    subs_list = []
+
+    for s in subs:
+        text = s.plaintext.strip()
+
+        # Temporary to correct pysubs2 parsing mistakes
+        if is_websub:
+            text = text.split('\n\n')[0]
+
+        if not skip_empty_subs or text.strip():
+            subs_list.append( { 'text': text, 'start': s.start, 'end': s.end } )
+
+    if file_identity and subs_cache:
+        subs_cache.write_text(cache_key, '.json', json.dumps(subs_list))
+
+    return subs_list
+
+
+def apply_subs_delay(subs_list, delay):
+
+    delayed_subs_list = []
+
+    for s in subs_list:
+        sub_start = max(s['start'] + delay, 0) // 10 * 10
+        sub_end = max(s['end'] + delay, 0) // 10 * 10
+        delayed_subs_list.append( { 'text': s['text'], 'start': sub_start, 'end': sub_end } )
+
+    return delayed_subs_list
+
+
+### Parsing the active subtitles in the background
+# mpv reports file and track changes, parsing them ahead makes opening the browser faster.
+# Changes are debounced, newer changes cancel older pre-parses between steps.
+
+preparse_subtitles = True
+preparse_delay = 1.0
+preparse_lock = threading.Lock()
+preparse_timer = None
+preparse_generation = 0
+
+
+def schedule_preparse():
+    global preparse_timer
+    global preparse_generation
+
+    if not preparse_subtitles:
+        return
+
+    with preparse_lock:
+        preparse_generation += 1
+        if preparse_timer is not None:
+            preparse_timer.cancel()
+        preparse_timer = threading.Timer(preparse_delay, preparse_subs, args=(preparse_generation,))
+        preparse_timer.daemon = True
+        preparse_timer.start()
+
+
+def preparse_subs(generation):
+
+    props = mpv.get_properties(['path', 'track-list'])
+
+    source_path = props['path']
+    track_list = props['track-list'] or []
+
+    if not source_path:
+        return
+
+    for secondary in [False, True]:
+        if generation != preparse_generation:
+            print('SUBS: Pre-parse cancelled')
+            return
+
+        sub_info = get_active_sub_info(track_list, secondary)
+        if not sub_info or 'migaku_parsed' in sub_info:
+            continue
+
+        start_time = time.time()
 
-        # Parse subs and generate json for frontend
         try:
-            with open(sub_path, encoding=subs_encoding, errors='replace') as fp:
-                subs = pysubs2.SSAFile.from_file(fp)
-        except:
-            raise SubtitleLoadError('Loading subtitle file "%s" failed.' % sub_path)
+            if '*' in sub_info:
+                # Without the track cache opening would export the track again, which is also
+                # the case for media that is not a local file (e.g. streamed by jellyfin or plex shims)
+                if track_cache is None:
+                    continue
+                try:
+                    FileCache.file_identity(source_path)
+                except OSError:
+                    continue
+                sub_path = internal_sub_path(sub_info, source_path, quiet=True)
+            else:
+                sub_path = path_clean(sub_info)
+                # Web subtitles are only downloaded when needed
+                if sub_path.startswith('edl://') or sub_path.startswith('http'):
+                    continue
+            if not sub_path or not os.path.isfile(sub_path):
+                continue
+            parse_subs_file(sub_path)
+        except SubtitleLoadError as e:
+            print('SUBS: Pre-parse failed:', e)
+            continue
 
-        subs.sort()
-        subs_list = []
+        print('SUBS: Pre-parsed %s in %.2fs' % (sub_info, time.time() - start_time))
 
-        for s in subs:
-            text = s.plaintext.strip()
 
-            # Temporary to correct pysubs2 parsing mistakes
-            if is_websub:
-                text = text.split('\n\n')[0]
+### Reading playback state from mpv
 
-            if not skip_empty_subs or text.strip():
-                sub_start = max(s.start + subs_delay, 0) // 10 * 10
-                sub_end = max(s.end + subs_delay, 0) // 10 * 10
-                subs_list.append( { 'text': text, 'start': sub_start, 'end': sub_end } )
+def get_active_sub_info(track_list, secondary=False):
 
-        return subs_list
+    main_selection = 1 if secondary else 0
 
+    for track in track_list:
+        if track.get('type') == 'sub' and track.get('selected') and track.get('main-selection') == main_selection:
+            sub_path = track.get('external-filename')
+            if sub_path is None:
+                sub_path = '%s*%s' % (track.get('ff-index'), track.get('codec'))
+            return sub_path
 
-### Called when user presses the migaku key in mpv, transmits info about playing environment
+    return ''
 
-# TODO: Split this
-def load_and_open_migaku(mpv_cwd, mpv_pid, mpv_media_path, mpv_audio_track, mpv_sub_info, mpv_secondary_sub_info, mpv_subs_delay, mpv_resx, mpv_resy):
-    global subs_json
-    global secondary_subs_json
-    global media_path
-    global audio_track
-    global subs_delay
-    global resx
-    global resy
+
+# Only supports internal audio
+def get_active_audio_track(track_list):
+
+    for track in track_list:
+        if track.get('type') == 'audio' and track.get('selected') and track.get('id') is not None and track.get('external-filename') is None:
+            return track['id']
+
+    return -1
+
+
+def get_video_resolution():
+
+    props = mpv.get_properties(['video-params/w', 'video-params/h'])
+
+    return (props['video-params/w'] or 1920, props['video-params/h'] or 1080)
+
+
+### Called when user presses the migaku key in mpv, requests the required info about playing environment
+
+def open_migaku():
 
     if port is None:
         mpv.show_text('Not ready...')
         return
 
+    props = mpv.get_properties(['working-directory', 'pid', 'path', 'track-list', 'sub-delay'])
+
+    if not props['path']:
+        return
+
+    track_list = props['track-list'] or []
+
+    # Subtitle loading can take a while, opening again meanwhile waits for it
+    with open_lock:
+        load_and_open_migaku(
+            props['working-directory'],
+            props['pid'],
+            props['path'],
+            get_active_audio_track(track_list),
+            get_active_sub_info(track_list),
+            get_active_sub_info(track_list, secondary=True),
+            props['sub-delay'] or 0,
+        )
+
+
+# TODO: Split this
+def load_and_open_migaku(mpv_cwd, mpv_pid, mpv_media_path, mpv_audio_track, mpv_sub_info, mpv_secondary_sub_info, mpv_subs_delay):
+    global subs_content
+    global secondary_subs_content
+    global subs_page_contents
+    global subs_index
+    global secondary_subs_index
+    global loaded_subs
+    global loaded_secondary_subs
+    global current_sub_ids
+    global media_path
+    global audio_track
+    global subs_delay
+    import psutil
+
     mpv_executable = psutil.Process(int(mpv_pid)).cmdline()[0]
 
     if os.path.split(mpv_executable)[-1].lower() in ['mpv', 'mpv.exe', 'mpv-bundle']:
@@ -493,10 +1126,6 @@ def load_and_open_migaku(mpv_cwd, mpv_pid, mpv_media_path, mpv_audio_track, mpv_
 
     subs_delay = int(round(float(mpv_subs_delay) * 1000))
 
-    resx = int(mpv_resx)
-    resy = int(mpv_resy)
-
-
     if not mpv_sub_info:
         mpv.show_text('Please select a subtitle track.')
         return
@@ -518,30 +1147,36 @@ def load_and_open_migaku(mpv_cwd, mpv_pid, mpv_media_path, mpv_audio_track, mpv_
         mpv.show_text(str(e))
         return
 
-    subs_json = json.dumps(subs)
-    secondary_subs_json = json.dumps(secondary_subs)
+    subs_index = SubtitleIndex(subs)
+    secondary_subs_index = SubtitleIndex(secondary_subs)
+    loaded_subs = subs
+    loaded_secondary_subs = secondary_subs
+    current_sub_ids = []
+
+    # Encoded and compressed once, requests for unchanged subs are answered with 304
+    subs_content = CachedContent(json.dumps(subs).encode(), 'application/json')
+    secondary_subs_content = CachedContent(json.dumps(secondary_subs).encode(), 'application/json')
+    subs_page_contents = make_subs_page_contents(subs)
 
     # Open or refresh frontend
     mpv.show_text('Opening in Browser...', 2.0)
 
     open_new_tab = False
 
-    data_queues_lock.acquire()
+    data_clients = server.get_event_clients('/data')
 
-    finalize_queues = data_queues
+    finalize_clients = data_clients
 
-    if reuse_last_tab and len(data_queues) > 0:
-        data_queues[-1].put('r')
-        finalize_queues = finalize_queues[:-1]
+    if reuse_last_tab and len(data_clients) > 0:
+        data_clients[-1].send('r')
+        finalize_clients = finalize_clients[:-1]
         t = threading.Thread(target=tab_reload_timeout)
         t.start()
     else:
         open_new_tab = True
 
-    for q in finalize_queues:
-        q.put('q')
-
-    data_queues_lock.release()
+    for c in finalize_clients:
+        c.close()
 
     if open_new_tab:
         open_webbrowser_new_tab()
@@ -570,7 +1205,7 @@ def resync_subtitle(resync_sub_path, resync_reference_path, resync_reference_tra
 
     # Run actual syncing in thread
     def sync_thread_func():
-        r = subprocess.run([ffsubsync, resync_reference_path, '-i', resync_sub_path, '-o', out_path, '--reftrack', resync_reference_track, '--ffmpeg-path', os.path.dirname(ffmpeg)])
+        r = metrics.run_process('ffsubsync', [ffsubsync, resync_reference_path, '-i', resync_sub_path, '-o', out_path, '--reftrack', resync_reference_track, '--ffmpeg-path', os.path.dirname(ffmpeg)])
 
         if r.returncode == 0:
             mpv.command('sub-add', out_path)
@@ -613,6 +1248,33 @@ def exception_hook_threads(args):
     exception_hook(args.exc_type, args.exc_value, args.exc_traceback)
 
 
+def log_startup_phase(phase):
+
+    print('STARTUP: %s after %.3fs' % (phase, time.perf_counter() - startup_time))
+
+
+# The old temp dir is moved aside and deleted in the background, removing many files can take a while
+def clear_tmp_dir():
+
+    old_tmp_dir = '%s_old_%d' % (tmp_dir, time.time_ns())
+
+    try:
+        os.rename(tmp_dir, old_tmp_dir)
+    except OSError:
+        pass    # Doesn't exist or files are still in use
+
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    def remove_old_tmp_dirs():
+        # Also catches leftovers of sessions that were killed while deleting
+        for entry in os.scandir(plugin_dir):
+            if entry.name.startswith(os.path.basename(tmp_dir) + '_old_') and entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    t = threading.Thread(target=remove_old_tmp_dirs, daemon=True)
+    t.start()
+
+
 def install_except_hooks():
     sys.excepthook = exception_hook
 
@@ -633,6 +1295,21 @@ def install_except_hooks():
         threading.Thread.run = run_new
 
 
+# Packaged rubysubs builds include the worker, otherwise it runs from source if rubysubs is importable
+def make_rubysubs_worker():
+
+    if rubysubs is None:
+        return None
+
+    if plugin_is_packaged:
+        return RubysubsWorker([rubysubs, '--worker'])
+
+    if importlib.util.find_spec('rubysubs') is not None:
+        return RubysubsWorker([sys.executable, os.path.join(plugin_dir, 'utils', 'rubysubs_worker.py'), '--worker'])
+
+    return None
+
+
 def find_executable(name, config_name=None):
 
     if config_name is None:
@@ -665,6 +1342,7 @@ def find_executable(name, config_name=None):
 def main():
     global log_file
     global mpv
+    global server
     global host
     global port
     global reuse_last_tab
@@ -673,6 +1351,7 @@ def main():
     global ffmpeg
     global ffsubsync
     global rubysubs
+    global rubysubs_worker
     global mpv_external
     global skip_empty_subs
     global sub_font_name
@@ -681,6 +1360,12 @@ def main():
     global sub_outline_size
     global sub_shadow_offset
     global subtitle_export_timeout
+    global extract_all_subtitle_tracks
+    global preparse_subtitles
+    global subs_cache
+    global track_cache
+    global styled_cache
+    global websubs_cache
 
     install_except_hooks()
 
@@ -702,9 +1387,9 @@ def main():
     if len(sys.argv) >= 3:
         config_path = sys.argv[2]
 
-    # Clear/create temp dir
-    shutil.rmtree(tmp_dir, ignore_errors=True)
-    os.makedirs(tmp_dir, exist_ok=True)
+    log_startup_phase('Started')
+
+    clear_tmp_dir()
 
     # Load config
     config_f = open(config_path, 'r', encoding="utf-8")
@@ -767,6 +1452,11 @@ def main():
     anki_exporter.image_format = config.get('anki_image_format', 'jpg')
     anki_exporter.audio_format = config.get('anki_audio_format', 'wav')
 
+    try:
+        anki_exporter.max_workers = max(1, int(config.get('anki_export_workers', 'auto')))
+    except:
+        pass
+
     print('ANKI:', vars(anki_exporter))
 
 
@@ -776,6 +1466,8 @@ def main():
     mpv_external = find_executable('mpv', 'mpv_external')
     print('EXES:', { 'ffmpeg': ffmpeg, 'ffsubsync': ffsubsync, 'rubysubs': rubysubs, 'mpv_external': mpv_external })
 
+    rubysubs_worker = make_rubysubs_worker()
+
     anki_exporter.ffmpeg_executable = ffmpeg
 
     skip_empty_subs = config.get('skip_empty_subs', 'yes').lower() == 'yes'
@@ -783,6 +1475,8 @@ def main():
         subtitle_export_timeout = float(config.get('subtitle_export_timeout', '0'))
     except:
         subtitle_export_timeout = 0
+    extract_all_subtitle_tracks = config.get('extract_all_subtitle_tracks', 'yes').lower() == 'yes'
+    preparse_subtitles = config.get('preparse_subtitles', 'yes').lower() == 'yes'
 
     sub_font_name = config.get('sub_font_name', 'Noto Sans CJK JP')
     sub_font_size = int(config.get('sub_font_size', '55'))
@@ -790,9 +1484,49 @@ def main():
     sub_outline_size = int(config.get('sub_outline_size', '3'))
     sub_shadow_offset = int(config.get('sub_shadow_offset', '0'))
 
+    try:
+        subtitle_cache_size = int(float(config.get('subtitle_cache_size', '64')) * 1024 * 1024)
+    except:
+        subtitle_cache_size = 64 * 1024 * 1024
+    try:
+        subs_cache = FileCache(os.path.join(cache_dir, 'subs'), subtitle_cache_size)
+    except OSError:
+        print('CACHE: Creating subtitle cache failed')
+
+    try:
+        internal_subtitle_cache_size = int(float(config.get('internal_subtitle_cache_size', '256')) * 1024 * 1024)
+    except:
+        internal_subtitle_cache_size = 256 * 1024 * 1024
+    try:
+        track_cache = FileCache(os.path.join(cache_dir, 'tracks'), internal_subtitle_cache_size)
+    except OSError:
+        print('CACHE: Creating internal subtitle track cache failed')
+
+    try:
+        styled_subtitle_cache_size = int(float(config.get('styled_subtitle_cache_size', '64')) * 1024 * 1024)
+    except:
+        styled_subtitle_cache_size = 64 * 1024 * 1024
+    try:
+        styled_cache = FileCache(os.path.join(cache_dir, 'styled'), styled_subtitle_cache_size)
+    except OSError:
+        print('CACHE: Creating styled subtitle cache failed')
+
+    try:
+        web_subtitle_cache_size = int(float(config.get('web_subtitle_cache_size', '32')) * 1024 * 1024)
+    except:
+        web_subtitle_cache_size = 32 * 1024 * 1024
+    try:
+        websubs_cache = FileCache(os.path.join(cache_dir, 'websubs'), web_subtitle_cache_size)
+    except OSError:
+        print('CACHE: Creating web subtitle cache failed')
+
+    log_startup_phase('Config loaded')
+
     # Init mpv IPC
     mpv = MpvIpc(sys.argv[1])
 
+    log_startup_phase('IPC connected')
+
     # Setup server
     server = HttpServer(host, try_ports)
     server.set_get_file_server('/', plugin_dir + '/migaku_mpv.html')
@@ -800,14 +1534,17 @@ def main():
         server.set_get_file_server(path, plugin_dir + path)
     server.set_get_handler('/subs', get_handler_subs)
     server.set_get_handler('/secondary_subs', get_handler_secondary_subs)
-    server.set_get_handler('/data', get_handler_data)
+    server.set_event_stream('/data')
     server.set_post_handler('/anki', post_handler_anki)
     server.set_post_handler('/mpv_control', post_handler_mpv_control)
     server.set_post_handler('/set_subs', post_handler_set_subs)
+    server.set_metrics_endpoint('/metrics')
     server.open()
 
     port = server.port
 
+    log_startup_phase('Ready')
+
     # Main loop, exits when IPC connection closes
     for data in mpv.listen():
         print('MPV:', data)
@@ -815,20 +1552,30 @@ def main():
             event_args = data.get('args', [])
             if len(event_args) >= 2 and event_args[0] == '@migaku':
                 cmd = event_args[1]
+                command_start = time.perf_counter()
                 if cmd == 'sub-start':
                     send_subtitle_time(event_args[2])
                 elif cmd == 'open':
-                    load_and_open_migaku(*event_args[2:10+1])
+                    # Runs outside of the IPC loop so replies to its requests can be received
+                    t = threading.Thread(target=open_migaku)
+                    t.start()
+                elif cmd == 'tracks-changed':
+                    schedule_preparse()
                 elif cmd == 'resync':
                     resync_subtitle(*event_args[2:4+1])
                 elif cmd == 'export':
                     browser_export_current()
                 elif cmd == 'lookup':
                     browser_lookup_current()
+                else:
+                    continue
+                ipc_command_duration.observe(cmd, value=time.perf_counter() - command_start)
 
-    # Close server
+    # Close server, also closes all data streams
     server.close()
-    stop_get_data_handlers()
+
+    if rubysubs_worker is not None:
+        rubysubs_worker.close()
 
     # Close mpv IPC
     mpv.close()
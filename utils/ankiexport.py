@@ -1,11 +1,14 @@
-import subprocess
-import requests
+import itertools
+import threading
 import time
 import json
 import os
+import concurrent.futures
 
 from enum import Enum
 
+from . import metrics
+
 class Errors(Enum):
     FFMPEG_SCREENSHOT_ERROR = 1
     MPV_SCREENSHOT_ERROR = 2
@@ -30,30 +33,176 @@ class AnkiExporter():
         self.migaku_anki_host = '127.0.0.1'
         self.migaku_anki_port = 44432
 
+        # (connect, read) timeouts in seconds, sending a card can wait for the browser extension
+        self.info_timeout = (3.0, 10.0)
+        self.sendcard_timeout = (3.0, 120.0)
+
+        # Sessions keep connections to the add-on open, one per thread as sessions are not thread safe
+        self.thread_local = threading.local()
+
+        self.col_media_path = None
+        self.col_media_path_time = 0
+        self.col_media_path_ttl = 60.0
+
         self.image_format = 'jpg'
         self.audio_format = 'wav'
 
         self.image_width = None
         self.image_height = None
 
+        self.max_workers = max(1, (os.cpu_count() or 1) // 2)     # Parallel media generation jobs for mass export
+
+        # Mass export generates media of cards in batches with one ffmpeg run each
+        # ffmpeg decodes everything between the first and last card of a batch, including the gaps
+        self.batch_max_cards = 32       # Limits outputs per ffmpeg run
+        self.batch_max_gap = 5.0        # Seconds between cards, larger gaps start a new batch
+        self.batch_max_duration = 60.0  # Seconds of media decoded per ffmpeg run
+
+        self.file_counter = itertools.count()
+
 
     def export_card(self, media_file, audio_track, text_primary, text_secondary, time_start, time_end, unknowns=[], bulk_id=0, bulk_count=1, bulk_timestamp=time.time()):
 
         print("MAKE CARD", media_file, text_primary) 
 
+        col_path = self.get_col_media_path()
+
+        img_name, audio_name = self.make_card_media(media_file, audio_track, time_start, time_end, col_path)
+
+        self.send_card(text_primary, text_secondary, unknowns, img_name, audio_name, bulk_id, bulk_count, bulk_timestamp)
+
+
+    # Exports multiple cards, media is generated in parallel while cards are sent in order
+    # cards is a list of dicts with text, translation_text, unknowns, start and end (in seconds)
+    def export_cards(self, media_file, audio_track, cards, progress_callback=None):
+
+        if len(cards) == 1:
+            card = cards[0]
+            self.export_card(media_file, audio_track, card['text'], card['translation_text'], card['start'], card['end'], card['unknowns'], 0, 1, time.time())
+            if progress_callback:
+                progress_callback(1, 1)
+            return
+
         if not media_file.startswith('http'):
             media_file = os.path.normpath(media_file)
 
+        col_path = self.get_col_media_path()
+        timestamp = time.time()
+
+        media_names = [self.make_media_names(col_path) for _ in cards]
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # Cards close to each other share one ffmpeg run, every batch is a separate job
+        futures = [None] * len(cards)
+        for batch in self.make_batches(cards):
+            batch_cards = [cards[i] for i in batch]
+            batch_media_names = [media_names[i] for i in batch]
+            future = executor.submit(self.make_cards_media, media_file, audio_track, batch_cards, batch_media_names)
+            for i in batch:
+                futures[i] = future
+
+        sent_count = 0
+
+        try:
+            for i, card in enumerate(cards):
+                futures[i].result()
+                img_name, img_path, audio_name, audio_path = media_names[i]
+                if not os.path.exists(img_path) or not os.path.exists(audio_path):
+                    self.invalidate_col_media_path()
+                    raise self.ExportError('Generating image/audio failed.')
+                self.send_card(card['text'], card['translation_text'], card['unknowns'], img_name, audio_name, i, len(cards), timestamp)
+                sent_count += 1
+                if progress_callback:
+                    progress_callback(i+1, len(cards))
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+            # Remove media of cards that were not sent
+            for _, img_path, _, audio_path in media_names[sent_count:]:
+                for path in [img_path, audio_path]:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+
+    # Groups card indices into batches of cards that are sorted and close to each other
+    # Batches are limited by card count and by the duration of media ffmpeg has to decode for them
+    def make_batches(self, cards):
+
+        order = sorted(range(len(cards)), key=lambda i: (cards[i]['start'], cards[i]['end']))
+
+        # Spread cards over all workers but keep the number of outputs per ffmpeg run limited
+        max_cards = min(self.batch_max_cards, max(1, -(-len(cards) // self.max_workers)))
+
+        batches = []
+        batch = []
+        batch_start = None
+        batch_end = None
+
+        for i in order:
+            card = cards[i]
+            if batch and (len(batch) >= max_cards or
+                          card['start'] - batch_end > self.batch_max_gap or
+                          max(batch_end, card['end']) - batch_start > self.batch_max_duration):
+                batches.append(batch)
+                batch = []
+            if not batch:
+                batch_start = card['start']
+                batch_end = card['end']
+            batch.append(i)
+            batch_end = max(batch_end, card['end'])
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+
+    # requests is imported on first use, it is only needed for exporting
+    def session(self):
+
+        import requests
+
+        session = getattr(self.thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.thread_local.session = session
+        return session
+
+
+    def invalidate_col_media_path(self):
+
+        self.col_media_path = None
+
+
+    # The path is cached for a while and invalidated whenever communicating with the add-on fails
+    def get_col_media_path(self):
+
+        import requests
+
+        col_media_path = self.col_media_path
+        if col_media_path is not None and time.time() - self.col_media_path_time < self.col_media_path_ttl:
+            return col_media_path
+
         try:
-            r = requests.get(F'http://{self.migaku_anki_host}:{self.migaku_anki_port}/info')
+            r = self.session().get(F'http://{self.migaku_anki_host}:{self.migaku_anki_port}/info', timeout=self.info_timeout)
             r.raise_for_status()
-        except requests.exceptions.RequestException as e:
+            info = r.json()
+            col_media_path = info['col_media_path']
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            self.invalidate_col_media_path()
             raise self.ExportError('Could not connect to Anki.\nMake sure Anki is running and the latest Migaku add-on is installed.')
 
-        info = r.json()
-        col_path = info['col_media_path']
-        
-        file_base = 'migaku-local-' + str(int(round(time.time() * 1000)))
+        self.col_media_path = col_media_path
+        self.col_media_path_time = time.time()
+        return col_media_path
+
+
+    def make_media_names(self, col_path):
+
+        file_base = 'migaku-local-%d-%d' % (round(time.time() * 1000), next(self.file_counter))
 
         img_name = file_base + '.' + self.image_format
         img_path = os.path.join(col_path, img_name)
@@ -63,12 +212,81 @@ class AnkiExporter():
         audio_path = os.path.join(col_path, audio_name)
         audio_path = os.path.normpath(audio_path)
 
-        error = self.make_audio(media_file, audio_track, time_start, time_end, audio_path)
-        error = self.make_screenshot(media_file, time_start, time_end, img_path)
+        return img_name, img_path, audio_name, audio_path
+
+
+    # Generates image and audio in the collection media folder, returns their file names
+    def make_card_media(self, media_file, audio_track, time_start, time_end, col_path):
+
+        if not media_file.startswith('http'):
+            media_file = os.path.normpath(media_file)
+
+        img_name, img_path, audio_name, audio_path = self.make_media_names(col_path)
+
+        error = self.make_audio_and_screenshot(media_file, audio_track, time_start, time_end, audio_path, img_path)
 
         if not os.path.exists(img_path) or not os.path.exists(audio_path):
+            self.invalidate_col_media_path()
             raise self.ExportError('Generating image/audio failed.')
 
+        return img_name, audio_name
+
+
+    # Generates image and audio for multiple cards in a single pass over the media
+    # Cards whose files were not generated fall back to the single card path
+    def make_cards_media(self, media_file, audio_track, cards, media_names):
+
+        if len(cards) == 1:
+            _, img_path, _, audio_path = media_names[0]
+            self.make_audio_and_screenshot(media_file, audio_track, cards[0]['start'], cards[0]['end'], audio_path, img_path)
+            return
+
+        self.ffmpeg_batch(media_file, audio_track, cards, media_names)
+
+        for card, (_, img_path, _, audio_path) in zip(cards, media_names):
+            if not os.path.exists(img_path) or not os.path.exists(audio_path):
+                self.make_audio_and_screenshot(media_file, audio_track, card['start'], card['end'], audio_path, img_path)
+
+
+    def ffmpeg_batch(self, media_file, audio_track, cards, media_names):
+        batch_start = min(card['start'] for card in cards)
+        batch_end = max(card['end'] for card in cards)
+
+        args = [
+                self.ffmpeg_executable,
+                '-y', '-loglevel', 'error',
+                '-ss', str(batch_start),
+                '-to', str(batch_end),
+                '-i', media_file,
+                ]
+
+        # Output positions are relative to the input seek position
+        for card, (_, img_path, _, audio_path) in zip(cards, media_names):
+            start = card['start'] - batch_start
+            end = card['end'] - batch_start
+            args.extend([
+                '-map', '0:' + str(audio_track),
+                '-ss', str(start),
+                '-t', str(end - start),
+                '-acodec', 'mp3',
+                audio_path,
+                '-map', '0:v:0',
+                '-ss', str((start + end) / 2),
+                '-vframes', '1',
+                *self.ffmpeg_scale_args(),
+                img_path,
+            ])
+
+        try:
+            metrics.run_process('ffmpeg', args, cwd=self.mpv_cwd)
+        except FileNotFoundError:
+            pass
+
+
+    def send_card(self, text_primary, text_secondary, unknowns, img_name, audio_name, bulk_id=0, bulk_count=1, bulk_timestamp=time.time()):
+
+        import requests
+
         data = {
             'version':              2,
             'timestamp':            round(bulk_timestamp),
@@ -82,16 +300,17 @@ class AnkiExporter():
         }
 
         try:
-            r = requests.post(
+            r = self.session().post(
                 F'http://{self.migaku_anki_host}:{self.migaku_anki_port}/sendcard',
                 json=data,
+                timeout=self.sendcard_timeout,
             )
             r.raise_for_status()
-        except requests.exceptions.RequestException:
+            status = r.json()['status']
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            self.invalidate_col_media_path()
             raise self.ExportError('Communication failed.\nMake sure the latest Migaku add-on is installed.')
 
-        status = r.json()['status']
-
         if status == 'not_connected':
             raise self.ExportError('Connection to browser extension failed.')
 
@@ -99,6 +318,52 @@ class AnkiExporter():
             raise self.ExportError('Cancelled.')
 
 
+    # Seeks only once and writes audio and screenshot as two outputs of one ffmpeg process
+    def ffmpeg_audio_and_screenshot(self, media_file, audio_track, start, end, audio_out_path, img_out_path):
+        args = [
+                self.ffmpeg_executable,
+                '-y', '-loglevel', 'error',
+                '-ss', str(start),
+                '-to', str(end),
+                '-i', media_file,
+                '-map', '0:' + str(audio_track),
+                '-acodec', 'mp3',
+                audio_out_path,
+                '-map', '0:v:0',
+                '-ss', str((end - start) / 2),      # Relative to the input seek position
+                '-vframes', '1',
+                *self.ffmpeg_scale_args(),
+                img_out_path
+                ]
+
+        error = None
+        try:
+            metrics.run_process('ffmpeg', args, cwd=self.mpv_cwd)
+        except FileNotFoundError:
+            pass
+
+        # Check that both files were saved
+        if not os.path.exists(audio_out_path):
+            error = Errors.FFMPEG_AUDIO_ERROR
+        elif not os.path.exists(img_out_path):
+            error = Errors.FFMPEG_SCREENSHOT_ERROR
+        return error
+
+    def make_audio_and_screenshot(self, media_file, audio_track, start, end, audio_out_path, img_out_path):
+        error = self.ffmpeg_audio_and_screenshot(media_file, audio_track, start, end, audio_out_path, img_out_path)
+
+        # Fall back to separate processes for whatever is missing
+        if error:
+            print("CARD MEDIA: Falling back to separate audio and screenshot generation")
+            error = None
+            if not os.path.exists(audio_out_path):
+                error = self.make_audio(media_file, audio_track, start, end, audio_out_path)
+            if not os.path.exists(img_out_path):
+                error = self.make_screenshot(media_file, start, end, img_out_path) or error
+
+        return error
+
+
     def ffmpeg_audio(self, media_file, audio_track, start, end, out_path):
         args = [
                 self.ffmpeg_executable,
@@ -113,8 +378,7 @@ class AnkiExporter():
 
         error = None
         try:
-            proc = subprocess.Popen(args, cwd=self.mpv_cwd)
-            proc.wait()
+            metrics.run_process('ffmpeg', args, cwd=self.mpv_cwd)
         except FileNotFoundError:
             pass
 
@@ -131,8 +395,7 @@ class AnkiExporter():
                 '--o=' + out_path]
 
         error = None
-        proc = subprocess.Popen(args, cwd=self.mpv_cwd)
-        proc.wait()
+        metrics.run_process('mpv', args, cwd=self.mpv_cwd)
 
         # Check that image was saved
         if not os.path.exists(out_path):
@@ -163,6 +426,20 @@ class AnkiExporter():
                 out_path
                 ]
 
+        args[-1:-1] = self.ffmpeg_scale_args()
+
+        error = None
+        try:
+            metrics.run_process('ffmpeg', args, cwd=self.mpv_cwd)
+        except FileNotFoundError:
+            pass
+
+        # Check that image was saved
+        if not os.path.exists(out_path):
+            error = Errors.FFMPEG_SCREENSHOT_ERROR
+        return error
+
+    def ffmpeg_scale_args(self):
         # See https://ffmpeg.org/ffmpeg-filters.html#scale-1 for scaling options
 
         # None or values smaller than 1 set the axis to auto
@@ -175,22 +452,13 @@ class AnkiExporter():
 
         # Only apply filter if any axis is set to non-auto
         if w > 0 or h > 0:
-                args[-1:-1] = [
-                    '-filter:v',
-                    'scale=w=\'min(iw,%d)\':h=\'min(ih,%d)\':force_original_aspect_ratio=decrease'
-                    % (w, h)
-                ]
-        error = None
-        try:
-            proc = subprocess.Popen(args, cwd=self.mpv_cwd)
-            proc.wait()
-        except FileNotFoundError:
-            pass
+            return [
+                '-filter:v',
+                'scale=w=\'min(iw,%d)\':h=\'min(ih,%d)\':force_original_aspect_ratio=decrease'
+                % (w, h)
+            ]
 
-        # Check that image was saved
-        if not os.path.exists(out_path):
-            error = Errors.FFMPEG_SCREENSHOT_ERROR
-        return error
+        return []
 
     def mpv_screenshot(self, media_file, start, end, out_path):
         args = [self.mpv_executable, '--load-scripts=no',                                       # start mpv without scripts
@@ -216,8 +484,7 @@ class AnkiExporter():
             args.append(scale_arg)
 
         error = None
-        proc = subprocess.Popen(args, cwd=self.mpv_cwd)
-        proc.wait()
+        metrics.run_process('mpv', args, cwd=self.mpv_cwd)
         # Check that image was saved
         if not os.path.exists(out_path):
             error = Errors.MPV_SCREENSHOT_ERROR
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+class FileCache():
+
+    def __init__(self, cache_dir, max_size=0):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size            # In bytes, 0 or lower disables the limit
+        self.lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    # Identifies a file by its location, modification time and size
+    @staticmethod
+    def file_identity(path):
+
+        st = os.stat(path)
+        return [os.path.abspath(path), st.st_mtime_ns, st.st_size]
+
+
+    # Content addressed key for any json serializable parts
+    @staticmethod
+    def make_key(*parts):
+
+        key_data = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+    def path(self, key, ext=''):
+
+        return os.path.join(self.cache_dir, key + ext)
+
+
+    # Returns the path of a cached entry or None, marks the entry as recently used
+    # Only the access time is updated, the modification time stays part of the file identity
+    def get(self, key, ext=''):
+
+        entry_path = self.path(key, ext)
+        try:
+            st = os.stat(entry_path)
+            os.utime(entry_path, ns=(time.time_ns(), st.st_mtime_ns))
+        except OSError:
+            return None
+        return entry_path
+
+
+    def read_bytes(self, key, ext=''):
+
+        entry_path = self.get(key, ext)
+        if entry_path is None:
+            return None
+        try:
+            with open(entry_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+    def read_text(self, key, ext=''):
+
+        data = self.read_bytes(key, ext)
+        if data is None:
+            return None
+        return data.decode('utf-8', errors='replace')
+
+
+    # Unique path inside the cache dir, commit() moves it into place
+    def temp_path(self, ext=''):
+
+        return os.path.join(self.cache_dir, 'tmp_%d_%d%s' % (threading.get_ident(), time.time_ns(), ext))
+
+
+    def commit(self, key, ext, src_path):
+
+        entry_path = self.path(key, ext)
+        os.replace(src_path, entry_path)
+        self.trim(entry_path)
+        return entry_path
+
+
+    def write_bytes(self, key, ext, data):
+
+        tmp_path = self.temp_path(ext)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            return self.commit(key, ext, tmp_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+
+    def write_text(self, key, ext, text):
+
+        return self.write_bytes(key, ext, text.encode('utf-8'))
+
+
+    # Removes least recently used entries until the cache fits into max_size
+    # keep_path is never removed, an entry that was just committed is returned to the caller even if it is larger than the cache
+    def trim(self, keep_path=None):
+
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            entries = []
+            total_size = 0
+
+            try:
+                dir_entries = list(os.scandir(self.cache_dir))
+            except OSError:
+                return
+
+            for entry in dir_entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                # Unfinished writes, only remove leftovers from crashed sessions
+                if entry.name.startswith('tmp_'):
+                    if st.st_mtime < time.time() - 3600:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+                total_size += st.st_size
+
+            entries.sort()
+
+            for _, size, entry_path in entries:
+                if total_size <= self.max_size:
+                    break
+                if entry_path == keep_path:
+                    continue
+                try:
+                    os.remove(entry_path)
+                    total_size -= size
+                except OSError:
+                    pass
@@ -0,0 +1,245 @@
+import time
+import threading
+import subprocess
+
+
+# Metrics in the Prometheus text format, see https://prometheus.io/docs/instrumenting/exposition_formats/
+# All metrics can be updated from any thread. Label values should come from a small fixed set.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label_value(value):
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def format_labels(label_names, label_values, extra=''):
+
+    labels = ['%s="%s"' % (name, escape_label_value(value)) for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+
+# Values are either updated explicitly or, if a function is set, computed when rendered
+# The function returns a dict that maps label value tuples to values. It suits values that are
+# already tracked elsewhere, or are updated too often to take the lock each time.
+class Metric():
+
+    TYPE = None
+
+    def __init__(self, name, help_text, label_names=()):
+
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}            # label values -> value
+        self.lock = threading.Lock()
+        self.function = None
+
+
+    def set_function(self, function):
+
+        self.function = function
+
+
+    def check_labels(self, label_values):
+
+        if len(label_values) != len(self.label_names):
+            raise ValueError('%s expects labels %s' % (self.name, self.label_names))
+
+
+    def render(self):
+
+        lines = [
+            '# HELP %s %s' % (self.name, self.help_text.replace('\\', '\\\\').replace('\n', '\\n')),
+            '# TYPE %s %s' % (self.name, self.TYPE),
+        ]
+        lines.extend(self.render_samples())
+        return lines
+
+
+    def render_samples(self):
+
+        if self.function is not None:
+            values = self.function()
+            with self.lock:
+                self.values = dict(values)
+
+        with self.lock:
+            values = sorted(self.values.items())
+
+        return ['%s%s %s' % (self.name, format_labels(self.label_names, label_values), format_value(value))
+                for label_values, value in values]
+
+
+
+class Counter(Metric):
+
+    TYPE = 'counter'
+
+    def inc(self, *label_values, amount=1):
+
+        self.check_labels(label_values)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+
+class Gauge(Metric):
+
+    TYPE = 'gauge'
+
+    def set(self, *label_values, value):
+
+        self.check_labels(label_values)
+        with self.lock:
+            self.values[label_values] = value
+
+
+
+class Histogram(Metric):
+
+    TYPE = 'histogram'
+
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    PROCESS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+
+    def observe(self, *label_values, value):
+
+        self.check_labels(label_values)
+
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]     # bucket counts, sum, count
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+
+    def render_samples(self):
+
+        with self.lock:
+            values = sorted((label_values, (list(entry[0]), entry[1], entry[2])) for label_values, entry in self.values.items())
+
+        lines = []
+
+        for label_values, (bucket_counts, total, count) in values:
+            # Buckets are stored separately and reported cumulatively
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % format_value(float(bound))     # Always with decimal point like other clients
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, label_values, le), cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, label_values, 'le="+Inf"'), count))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.label_names, label_values), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.label_names, label_values), count))
+
+        return lines
+
+
+
+class MetricsRegistry():
+
+    def __init__(self):
+
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    # Returns the existing metric if one with the same name was registered before
+    def register(self, metric):
+
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError('Metric %s registered twice with different types or labels' % metric.name)
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+
+    def counter(self, name, help_text, label_names=()):
+
+        return self.register(Counter(name, help_text, label_names))
+
+
+    def gauge(self, name, help_text, label_names=()):
+
+        return self.register(Gauge(name, help_text, label_names))
+
+
+    def histogram(self, name, help_text, label_names=(), buckets=Histogram.LATENCY_BUCKETS):
+
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+
+    def render(self):
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+
+registry = MetricsRegistry()
+
+
+### External processes
+
+process_duration = registry.histogram('migaku_process_duration_seconds',
+                                      'Run time of external processes',
+                                      ('process',), Histogram.PROCESS_BUCKETS)
+process_exits = registry.counter('migaku_process_exits_total',
+                                 'Finished external processes by exit code, "timeout" or "error" if it could not be run',
+                                 ('process', 'exit_code'))
+
+
+def observe_process(name, seconds, exit_code):
+
+    process_duration.observe(name, value=seconds)
+    process_exits.inc(name, str(exit_code))
+
+
+# subprocess.run that records the run time and exit code under name
+def run_process(name, args, **kwargs):
+
+    start = time.perf_counter()
+    try:
+        r = subprocess.run(args, **kwargs)
+    except subprocess.TimeoutExpired:
+        observe_process(name, time.perf_counter() - start, 'timeout')
+        raise
+    except Exception:
+        observe_process(name, time.perf_counter() - start, 'error')
+        raise
+
+    observe_process(name, time.perf_counter() - start, r.returncode)
+    return r
@@ -2,41 +2,138 @@ import socket
 import os
 import json
 import time
+import itertools
 import threading
+import concurrent.futures
+
+from . import metrics
+
+
+ipc_messages = metrics.registry.counter('migaku_mpv_ipc_messages_total',
+                                        'Messages received from mpv by event name, "reply" for replies to requests',
+                                        ('type',))
+ipc_received_bytes = metrics.registry.counter('migaku_mpv_ipc_received_bytes_total', 'Data received from mpv')
 
 
 class MpvIpc_Base():
 
+    class RequestError(Exception):
+        pass
+
     def __init__(self, ipc_handle_path):
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}      # request_id -> Future
+        self.send_lock = threading.Lock()
+        self.listen_thread = None
+
+        # Only updated by the thread running listen(), read when metrics are rendered
+        self.message_counts = {}        # event name or 'reply' -> count
+        self.received_bytes = 0
+        ipc_messages.set_function(lambda: { (name,): count for name, count in list(self.message_counts.items()) })
+        ipc_received_bytes.set_function(lambda: { (): self.received_bytes })
+
         self.port_open(ipc_handle_path)
 
     def close(self):
         self.port_close()
 
+    READ_SIZE = 64 * 1024
+
     # Starts a loop that yields received json data
+    # Replies to requests made with request() are not yielded but resolve their futures
     # Exits when mpv closes the pipe or any errors occur
     def listen(self):
-        data = b''
+        self.listen_thread = threading.current_thread()
+        message_counts = self.message_counts
+        buffer = bytearray()
         try:
             while True:
-                new_data = self.port_read(1024)
+                new_data = self.port_read(self.READ_SIZE)
                 if new_data == b'':
                     break
-                data += new_data
-                if data[-1] != 10:
-                    continue       
-                utf8_data = data.decode('utf-8', errors='ignore')
-                for line in utf8_data.split('\n'):
-                    if line != '':
+                self.received_bytes += len(new_data)
+
+                # Only scan the new data for line ends, earlier data is known to contain none
+                scan_start = len(buffer)
+                buffer += new_data
+
+                line_start = 0
+                while True:
+                    line_end = buffer.find(b'\n', scan_start)
+                    if line_end < 0:
+                        break
+                    line = buffer[line_start:line_end].decode('utf-8', errors='ignore')
+                    line_start = scan_start = line_end + 1
+                    if line.strip() != '':
                         loaded_data = json.loads(line)
+                        if 'request_id' in loaded_data and self.resolve_request(loaded_data):
+                            message_counts['reply'] = message_counts.get('reply', 0) + 1
+                            continue
+                        message_type = str(loaded_data.get('event', 'other'))
+                        message_counts[message_type] = message_counts.get(message_type, 0) + 1
                         yield loaded_data
-                data = b''
+
+                del buffer[:line_start]
 
         except (OSError, BrokenPipeError, EOFError):
             pass
 
+        finally:
+            # Nobody will answer anymore
+            for request_id in list(self.pending_requests):
+                future = self.pending_requests.pop(request_id, None)
+                if future is not None:
+                    future.set_exception(self.RequestError('IPC connection closed'))
+
+    def resolve_request(self, data):
+        future = self.pending_requests.pop(data['request_id'], None)
+        if future is None:
+            return False
+        if data.get('error') == 'success':
+            future.set_result(data.get('data'))
+        else:
+            future.set_exception(self.RequestError(data.get('error')))
+        return True
+
+    # Sends a command and returns a concurrent.futures.Future that resolves to the reply data
+    def request(self, command, *args):
+        request_id = next(self.request_ids)
+        future = concurrent.futures.Future()
+        self.pending_requests[request_id] = future
+        send_args = [command] + list(args)
+        try:
+            self.send_json({ 'command': send_args, 'request_id': request_id })
+        except OSError as e:
+            self.pending_requests.pop(request_id, None)
+            future.set_exception(self.RequestError(str(e)))
+        return future
+
+    # Blocks until the reply arrived, must not be called from the thread running listen()
+    def wait(self, future, timeout=5.0):
+        if threading.current_thread() is self.listen_thread:
+            raise RuntimeError('Waiting for mpv replies in the listening thread would block forever')
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise self.RequestError('Request timed out')
+
+    def get_property(self, name, timeout=5.0):
+        return self.wait(self.request('get_property', name), timeout)
+
+    # Requests all properties at once, unavailable properties are set to default
+    def get_properties(self, names, default=None, timeout=5.0):
+        futures = { name: self.request('get_property', name) for name in names }
+        ret = {}
+        for name, future in futures.items():
+            try:
+                ret[name] = self.wait(future, timeout)
+            except self.RequestError:
+                ret[name] = default
+        return ret
+
     def send_json_txt(self, data):
-        self.port_send(data.encode('utf-8') + b'\n')
+        with self.send_lock:
+            self.port_send(data.encode('utf-8') + b'\n')
 
     def send_json(self, data):
         self.send_json_txt(json.dumps(data))
@@ -78,7 +175,7 @@ class MpvIpc_Unix(MpvIpc_Base):
             pass
 
     def port_send(self, data):
-        self.socket.send(data)
+        self.socket.sendall(data)
 
     def port_read(self, readlen):
         return self.socket.recv(readlen)
@@ -0,0 +1,171 @@
+import sys
+import json
+import threading
+import subprocess
+
+
+# Runs rubysubs jobs in a long-lived process so the interpreter startup and the
+# import of rubysubs with its parser data is only paid once.
+#
+# Protocol: one json object per line in both directions. The worker announces
+# itself with {"ready": true}, each job {"in": ..., "out": ..., "parser": ..., "args": [...]}
+# is answered with {"ok": true} or {"ok": false, "error": ...}.
+
+
+class RubysubsWorkerError(Exception):
+    pass
+
+
+class RubysubsWorker():
+
+    def __init__(self, args):
+
+        self.args = args
+        self.process = None
+        self.available = True       # Cleared if the worker can't be started at all (e.g. rubysubs without worker support)
+        self.lock = threading.Lock()
+
+
+    def start(self):
+
+        try:
+            self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            encoding='utf-8', bufsize=1)
+            reply = self.read_reply()
+        except (OSError, RubysubsWorkerError):
+            reply = {}
+
+        if not reply.get('ready'):
+            self.stop()
+            self.available = False
+            raise RubysubsWorkerError('Worker did not start')
+
+        print('RUBYSUBS: Worker started')
+
+
+    def stop(self):
+
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.stdout.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=2.0)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+
+    def read_reply(self):
+
+        line = self.process.stdout.readline()
+        if not line:
+            raise RubysubsWorkerError('Worker exited with code %s' % self.process.poll())
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise RubysubsWorkerError('Invalid reply from worker')
+
+
+    # Converts in_path to out_path, (re)starting the worker if it is not running
+    def convert(self, in_path, out_path, parser, parser_args):
+
+        job = { 'in': in_path, 'out': out_path, 'parser': parser, 'args': list(parser_args) }
+
+        with self.lock:
+            if not self.available:
+                raise RubysubsWorkerError('Worker not available')
+
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self.process = None
+                    self.start()
+
+                self.process.stdin.write(json.dumps(job) + '\n')
+                self.process.stdin.flush()
+
+                reply = self.read_reply()
+            except (OSError, RubysubsWorkerError) as e:
+                # Crashed or unusable, the next job starts a new worker
+                if self.process is not None:
+                    self.process.kill()
+                    self.process = None
+                raise RubysubsWorkerError(str(e))
+
+        if not reply.get('ok'):
+            raise RubysubsWorkerError(reply.get('error', 'Conversion failed'))
+
+
+    def close(self):
+
+        with self.lock:
+            self.stop()
+
+
+
+### Worker process
+
+def worker_main():
+
+    # stdout is reserved for replies, anything rubysubs prints goes to stderr
+    reply_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    import rubysubs
+    from PyQt5.QtGui import QGuiApplication
+
+    tag_parser_builders = {
+        'ruby':     rubysubs.tag_parse_ruby.parser_from_string_args,
+        'ja':       rubysubs.tag_parse_migaku_ja.parser_from_string_args,
+        'zh':       rubysubs.tag_parse_migaku_zh.parser_from_string_args,
+        'zh_hk':    rubysubs.tag_parse_migaku_zh.parser_from_string_args_HK,
+        'eu':       rubysubs.tag_parse_migaku_eu.parser_from_string_args,
+        'ko':       rubysubs.tag_parse_migaku_ko.parser_from_string_args,
+    }
+
+    # Required for QFontMetrics
+    qapp = QGuiApplication(sys.argv[:1])
+
+    def reply(data):
+        reply_out.write(json.dumps(data) + '\n')
+        reply_out.flush()
+
+    reply({ 'ready': True })
+
+    for line in sys.stdin:
+        try:
+            job = json.loads(line)
+
+            tag_parser_requested = job['parser'].lower().replace('-', '_')
+            if tag_parser_requested not in tag_parser_builders:
+                reply({ 'ok': False, 'error': 'Invalid tag parser.' })
+                continue
+
+            tag_parser = tag_parser_builders[tag_parser_requested](job['args'])
+
+            rubysubs.convert_sub_file(job['in'], job['out'], tag_parser)
+        except Exception as e:
+            reply({ 'ok': False, 'error': '%s: %s' % (type(e).__name__, e) })
+            continue
+
+        reply({ 'ok': True })
+
+
+def main():
+
+    if len(sys.argv) >= 2 and sys.argv[1] == '--worker':
+        worker_main()
+    else:
+        import rubysubs.__main__
+        rubysubs.__main__.main()
+
+
+if __name__ == '__main__':
+    main()
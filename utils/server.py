@@ -1,7 +1,31 @@
+import os
+import sys
+import gzip
+import time
 import socket
 import errno
+import hashlib
+import mimetypes
+import selectors
 import threading
+import collections
+import urllib.parse
+import concurrent.futures
 
+from socket import timeout as SocketTimeout
+
+from . import metrics
+
+
+http_requests = metrics.registry.counter('migaku_http_requests_total', 'Handled HTTP requests', ('method', 'route'))
+http_request_duration = metrics.registry.histogram('migaku_http_request_duration_seconds',
+                                                   'Time to handle HTTP requests, event streams are counted until they are opened',
+                                                   ('method', 'route'))
+event_stream_clients = metrics.registry.gauge('migaku_sse_clients', 'Connected event stream clients', ('stream',))
+event_stream_queued = metrics.registry.gauge('migaku_sse_queued_messages', 'Messages waiting in the queues of all clients', ('stream',))
+event_stream_max_queued = metrics.registry.gauge('migaku_sse_max_queue_depth', 'Messages waiting in the longest client queue', ('stream',))
+event_stream_pending = metrics.registry.gauge('migaku_sse_pending_bytes', 'Data taken from the client queues but not written yet', ('stream',))
+event_stream_dropped = metrics.registry.counter('migaku_sse_dropped_messages_total', 'Messages dropped because a client queue was full', ('stream',))
 
 
 
@@ -42,6 +66,7 @@ class HttpResponse():
         415: 'Unsupported Media Type',
         416: 'Requested range not satisfiable',
         417: 'Expectation Failed',
+        431: 'Request Header Fields Too Large',
         500: 'Internal Server Error',
         501: 'Not Implemented',
         502: 'Bad Gateway',
@@ -51,7 +76,8 @@ class HttpResponse():
     }
 
 
-    def __init__(self, code=200, content=None, content_type=None, headers={}):
+    # Streamed responses have no known length, all others with a body always send Content-Length for keep-alive
+    def __init__(self, code=200, content=None, content_type=None, headers={}, stream=False):
 
         self.code = code
         if code not in self.STATUS_FOR_CODE:
@@ -60,6 +86,7 @@ class HttpResponse():
         self.content = content
         self.content_type = content_type
         self.headers = headers
+        self.stream = stream
 
 
     def header_text(self):
@@ -67,8 +94,8 @@ class HttpResponse():
 
         ret.append('HTTP/1.1 %d %s' % (self.code, self.STATUS_FOR_CODE[self.code]))
     
-        if self.content:
-            ret.append('Content-Length: ' + str(len(self.content)))
+        if not self.stream and self.code not in [204, 304]:
+            ret.append('Content-Length: ' + str(len(self.content) if self.content else 0))
         if self.content_type:
             ret.append('Content-Type: ' + self.content_type)
 
@@ -80,15 +107,274 @@ class HttpResponse():
 
     def send(self, socket):
 
-        socket.send(self.header_text().encode())
+        socket.sendall(self.header_text().encode())
         if self.content:
-            socket.send(self.content)
+            socket.sendall(self.content)
+
+
+
+class HttpRequest():
+
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 32 * 1024 * 1024    # Largest bodies are subtitle lists and mass exports
+    READ_SIZE = 64 * 1024
+
+    class ParseError(Exception):
+
+        def __init__(self, code):
+            super().__init__(code)
+            self.code = code
+
+
+    def __init__(self, method, uri, version, headers, body):
+
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers      # Lower case names
+        self.body = body
+
+        uri_split = urllib.parse.urlsplit(uri)
+        self.path = urllib.parse.unquote(uri_split.path)
+        self.query = dict(urllib.parse.parse_qsl(uri_split.query))
+
+
+    def keep_alive(self):
+
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+    # Reads one request from the socket, using and extending the already received data in buffer
+    # Returns None if the connection was closed before a request started
+    @classmethod
+    def read(cls, socket, buffer):
+
+        while True:
+            header_end = buffer.find(b'\r\n\r\n')
+            if header_end >= 0:
+                break
+            if len(buffer) > cls.MAX_HEADER_SIZE:
+                raise cls.ParseError(431)
+            data = socket.recv(cls.READ_SIZE)
+            if not data:
+                if buffer.strip():
+                    raise cls.ParseError(400)
+                return None
+            buffer.extend(data)
+
+        header_lines = bytes(buffer[:header_end]).decode('iso-8859-1').split('\r\n')
+        del buffer[:header_end+4]
+
+        try:
+            method, uri, version = header_lines[0].split()
+        except ValueError:
+            raise cls.ParseError(400)
+
+        headers = {}
+        for line in header_lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise cls.ParseError(400)
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise cls.ParseError(411)
+
+        try:
+            content_length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise cls.ParseError(400)
+        if content_length < 0:
+            raise cls.ParseError(400)
+        if content_length > cls.MAX_BODY_SIZE:
+            raise cls.ParseError(413)
+
+        while len(buffer) < content_length:
+            data = socket.recv(cls.READ_SIZE)
+            if not data:
+                raise cls.ParseError(400)
+            buffer.extend(data)
+
+        body = None
+        if 'content-length' in headers:
+            body = bytes(buffer[:content_length])
+        del buffer[:content_length]
+
+        return cls(method, uri, version, headers, body)
+
+
+
+class CachedContent():
+
+    MIN_COMPRESS_SIZE = 1024
+
+    COMPRESSIBLE_TYPES = ['application/json', 'application/javascript', 'image/svg+xml']
+
+
+    def __init__(self, content, content_type=None, etag=None):
+
+        self.content = content
+        self.content_type = content_type
+
+        if etag is None:
+            etag = hashlib.sha1(content).hexdigest()
+        self.etag = '"' + etag + '"'
+
+        # Only keep compressed variant if it is actually smaller
+        self.gzip_content = None
+        if self.is_compressible() and len(content) >= self.MIN_COMPRESS_SIZE:
+            gzip_content = gzip.compress(content, compresslevel=6)
+            if len(gzip_content) < len(content):
+                self.gzip_content = gzip_content
+
+
+    def is_compressible(self):
+
+        if not self.content_type:
+            return False
+        mime_type = self.content_type.split(';')[0].strip()
+        return mime_type.startswith('text/') or mime_type in self.COMPRESSIBLE_TYPES
+
+
+    @staticmethod
+    def accepts_gzip(request):
+
+        for encoding in request.headers.get('accept-encoding', '').split(','):
+            name, _, params = encoding.partition(';')
+            if name.strip().lower() == 'gzip':
+                return params.replace(' ', '') not in ['q=0', 'q=0.0', 'q=0.00', 'q=0.000']
+        return False
+
+
+    # Sends the content, a 304 if the client has the current version or the gzip variant if accepted
+    # Extra headers are also sent with 304 responses, clients then update their stored headers
+    def send(self, socket, request=None, extra_headers={}):
+
+        headers = {
+            'ETag': self.etag,
+            'Cache-Control': 'no-cache',        # Always revalidate
+            'Vary': 'Accept-Encoding',
+            **extra_headers,
+        }
+
+        if request is not None:
+            if_none_match = request.headers.get('if-none-match', '')
+            if self.etag in [tag.strip() for tag in if_none_match.split(',')]:
+                HttpResponse(304, headers=headers).send(socket)
+                return
+
+            if self.gzip_content is not None and self.accepts_gzip(request):
+                headers['Content-Encoding'] = 'gzip'
+                HttpResponse(content=self.gzip_content, content_type=self.content_type, headers=headers).send(socket)
+                return
+
+        HttpResponse(content=self.content, content_type=self.content_type, headers=headers).send(socket)
+
+
+
+class HttpConnection():
+
+    def __init__(self, socket, address):
+
+        self.socket = socket
+        self.address = address
+        self.buffer = bytearray()       # Received data that was not processed yet
+        self.idle_since = time.monotonic()
+
+
+
+class EventStreamClient():
+
+    MAX_QUEUED_MESSAGES = 64
+
+    def __init__(self, server, uri, socket):
+
+        self.server = server
+        self.uri = uri
+        self.socket = socket
+
+        # Filled by any thread, drained by the event loop
+        # Entries are messages or coalesce slots [coalesce_key, message] that keep the position of the first
+        # undelivered message of their key, later ones only replace the message in the slot.
+        # When full the oldest entries are dropped.
+        self.messages = collections.deque()
+        self.coalesce_slots = {}        # coalesce_key -> slot that can still be updated
+        self.messages_lock = threading.Lock()
+        self.close_requested = False
+
+        self.pending = bytearray()      # Event loop only, data currently being written
+        self.is_registered = False
+        self.is_closing = False
+
+
+    def send(self, data, coalesce_key=None, wakeup=True):
+
+        message = ('data: ' + data + '\r\n\r\n').encode()
+
+        with self.messages_lock:
+            if coalesce_key is None:
+                # Coalesced messages sent after this one must not be delivered before it
+                self.coalesce_slots.clear()
+                self.append_message(message)
+            else:
+                slot = self.coalesce_slots.get(coalesce_key)
+                if slot is not None:
+                    slot[1] = message
+                else:
+                    slot = [coalesce_key, message]
+                    self.coalesce_slots[coalesce_key] = slot
+                    self.append_message(slot)
+
+        self.server.schedule_event_client(self, wakeup)
+
+
+    # Requires messages_lock
+    def append_message(self, entry):
+
+        if len(self.messages) >= self.MAX_QUEUED_MESSAGES:
+            dropped = self.messages.popleft()
+            if isinstance(dropped, list) and self.coalesce_slots.get(dropped[0]) is dropped:
+                del self.coalesce_slots[dropped[0]]
+            event_stream_dropped.inc(self.uri)
+
+        self.messages.append(entry)
+
+
+    def close(self):
+
+        self.close_requested = True
+        self.server.schedule_event_client(self)
+
+
+    def queue_depth(self):
+
+        return len(self.messages)
+
+
+    # Event loop only
+    def take_messages(self):
+
+        data = bytearray()
+
+        with self.messages_lock:
+            for entry in self.messages:
+                if isinstance(entry, list):
+                    data += entry[1]
+                else:
+                    data += entry
+            self.messages.clear()
+            self.coalesce_slots.clear()
+
+        return data
 
 
 
 class HttpServer():
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, max_workers=8, keep_alive_timeout=15.0):
 
         self.host = host
         if hasattr(port, '__iter__'):
@@ -100,10 +386,30 @@ class HttpServer():
         self.server_socket = None
         self.is_closing = False
 
+        self.max_workers = max_workers
+        self.keep_alive_timeout = keep_alive_timeout
+        self.executor = None
+        self.selector = None
+        self.loop_thread = None
+
+        # Used to wake up the event loop from other threads
+        self.wakeup_recv = None
+        self.wakeup_send = None
+
         self.get_file_servers = {}
+        self.get_file_contents = {}     # uri -> (mtime, CachedContent)
+        self.get_file_contents_lock = threading.Lock()
         self.get_handlers = {}
         self.post_handlers = {}
 
+        self.event_streams = set()
+        self.event_clients = ()         # In order of connection, only replaced by the event loop
+
+        # Filled by any thread, drained by the event loop
+        self.loop_tasks = collections.deque()           # (function, args) pairs
+        self.scheduled_clients = collections.deque()    # Event stream clients with new messages
+        self.is_woken_up = False
+
 
     def open(self):
 
@@ -126,11 +432,22 @@ class HttpServer():
             raise OSError(errno.EADDRINUSE, 'No free port found.')
 
         self.server_socket.listen(5)
+        self.server_socket.setblocking(False)
+
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='HttpServer')
 
         self.is_closing = False
-        self.listener_thread = threading.Thread(target=self.client_listener)
-        self.listener_thread.start()        
-        
+        self.loop_thread = threading.Thread(target=self.event_loop)
+        self.loop_thread.start()
+
 
     def close(self):
 
@@ -138,12 +455,14 @@ class HttpServer():
             return
 
         self.is_closing = True
-        try:
-            self.server_socket.shutdown(socket.SHUT_RDWR)
-        except OSError:
-            pass
+        self.wakeup()
+        self.loop_thread.join()
+
+        self.selector.close()
         self.server_socket.close()
-        self.listener_thread.join()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        self.executor.shutdown(wait=False)
         self.server_socket = None
 
 
@@ -152,6 +471,34 @@ class HttpServer():
         self.get_file_servers[uri] = serve_path
 
 
+    # Files are kept in memory and only read again when they were modified
+    def get_file_content(self, uri):
+
+        serve_path = self.get_file_servers[uri]
+        mtime = os.stat(serve_path).st_mtime_ns
+
+        with self.get_file_contents_lock:
+            cached = self.get_file_contents.get(uri)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+        with open(serve_path, 'rb') as f:
+            serve_content = f.read()
+
+        content_type, _ = mimetypes.guess_type(serve_path)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+
+        content = CachedContent(serve_content, content_type)
+
+        with self.get_file_contents_lock:
+            self.get_file_contents[uri] = (mtime, content)
+
+        return content
+
+
     def set_get_handler(self, uri, handler):
 
         self.get_handlers[uri] = handler
@@ -162,70 +509,383 @@ class HttpServer():
         self.post_handlers[uri] = handler
 
 
-    def client_listener(self):
+    # GET requests to uri open a server-sent event stream that is served by the event loop
+    def set_event_stream(self, uri):
+
+        self.event_streams.add(uri)
+
+
+    # GET requests to uri return all metrics in the Prometheus text format
+    def set_metrics_endpoint(self, uri):
+
+        event_stream_clients.set_function(lambda: self.event_client_values(lambda c: 1))
+        event_stream_queued.set_function(lambda: self.event_client_values(lambda c: c.queue_depth()))
+        event_stream_max_queued.set_function(lambda: self.event_client_values(lambda c: c.queue_depth(), max))
+        event_stream_pending.set_function(lambda: self.event_client_values(lambda c: len(c.pending)))
+
+        self.set_get_handler(uri, self.get_handler_metrics)
+
+
+    def get_handler_metrics(self, socket, request):
+
+        r = HttpResponse(content=metrics.registry.render(), content_type=metrics.CONTENT_TYPE, headers={'Cache-Control': 'no-cache'})
+        r.send(socket)
+
+
+    # Combines a value of all open clients per event stream, read without locking from any thread
+    def event_client_values(self, value, combine=sum):
+
+        values = { uri: [] for uri in self.event_streams }
+        for client in self.event_clients:
+            if not client.close_requested:
+                values.setdefault(client.uri, []).append(value(client))
+
+        return { (uri,): combine(client_values) if client_values else 0 for uri, client_values in values.items() }
+
+
+    def get_event_clients(self, uri):
+
+        return [c for c in self.event_clients if c.uri == uri and not c.close_requested]
+
+
+    def send_event(self, uri, data, coalesce_key=None):
+
+        for client in self.get_event_clients(uri):
+            client.send(data, coalesce_key, wakeup=False)
+        self.wakeup()
+
+
+    def schedule_event_client(self, client, wakeup=True):
+
+        self.scheduled_clients.append(client)
+        if wakeup:
+            self.wakeup()
+
+
+    def call_in_loop(self, function, *args):
+
+        self.loop_tasks.append((function, args))
+        self.wakeup()
+
+
+    def wakeup(self):
+
+        # Flag is cleared by the event loop before it processes queued work, after draining the socket
+        if self.is_woken_up:
+            return
+        self.is_woken_up = True
+
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass    # Loop is already woken up or closed
+
+
+    def event_loop(self):
 
         while not self.is_closing:
+            for key, mask in self.selector.select(timeout=self.keep_alive_timeout / 2):
+                if key.fileobj is self.server_socket:
+                    self.accept_clients()
+                elif key.fileobj is self.wakeup_recv:
+                    self.process_loop_tasks()
+                elif isinstance(key.data, EventStreamClient):
+                    self.process_event_client(key.data, mask)
+                else:
+                    self.dispatch_connection(key.data)
+
+            self.close_idle_connections()
+
+        # Shut down all remaining connections
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is self.server_socket or key.fileobj is self.wakeup_recv:
+                continue
+            if isinstance(key.data, EventStreamClient):
+                self.close_event_client(key.data)
+            else:
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+
+    def accept_clients(self):
+
+        while True:
             try:
                 client_socket, client_address = self.server_socket.accept()
-            except:
-                continue
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+
+            # Wait for the request to arrive before using up a worker
+            self.idle_connection(HttpConnection(client_socket, client_address))
+
+
+    # Connections without pending requests wait in the event loop instead of a worker
+    def idle_connection(self, connection):
+
+        if self.is_closing:
+            connection.socket.close()
+            return
+
+        connection.socket.setblocking(False)
+        connection.idle_since = time.monotonic()
+        self.selector.register(connection.socket, selectors.EVENT_READ, connection)
+
+
+    def close_idle_connections(self):
 
-            handler_thread = threading.Thread(target=self.client_handler, args=(client_socket, client_address))
-            handler_thread.start()
+        min_idle_since = time.monotonic() - self.keep_alive_timeout
 
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, HttpConnection) and key.data.idle_since < min_idle_since:
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
 
-    def client_handler(self, socket, address):
+
+    def dispatch_connection(self, connection):
+
+        self.selector.unregister(connection.socket)
+        # Stalled clients must not keep a worker forever
+        connection.socket.settimeout(self.keep_alive_timeout)
+        self.executor.submit(self.run_client_handler, connection)
+
+
+    # Executor futures swallow exceptions, report them like unhandled thread exceptions instead
+    def run_client_handler(self, connection):
 
         try:
-            recv_data = socket.recv(1024)
-            header_line_end = recv_data.find(b'\r')
-            header_line_segs = recv_data[:header_line_end].decode().split()
-            method = header_line_segs[0]
-            uri = header_line_segs[1]
+            self.client_handler(connection)
         except:
-            socket.close()
+            connection.socket.close()
+            sys.excepthook(*sys.exc_info())
+
+
+    def process_loop_tasks(self):
+
+        try:
+            while self.wakeup_recv.recv(1024):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+        # Only cleared after draining, a wakeup in between would otherwise leave the flag set without a pending byte
+        self.is_woken_up = False
+
+        while True:
+            try:
+                function, args = self.loop_tasks.popleft()
+            except IndexError:
+                break
+            function(*args)
+
+        scheduled_clients = set()
+        while True:
+            try:
+                scheduled_clients.add(self.scheduled_clients.popleft())
+            except IndexError:
+                break
+
+        for client in scheduled_clients:
+            if client.is_registered:
+                self.flush_event_client(client)
+
+
+    def add_event_client(self, client):
+
+        client.socket.setblocking(False)
+        self.selector.register(client.socket, selectors.EVENT_READ, client)
+        client.is_registered = True
+
+        self.event_clients = self.event_clients + (client,)
+
+        self.flush_event_client(client)
+
+
+    def process_event_client(self, client, mask):
+
+        # Closed earlier in the same batch of selector events
+        if client.socket is None:
             return
 
-        if method == 'GET':
-            serve_path = self.get_file_servers.get(uri)
-            if serve_path:
-                f = open(serve_path, 'rb')
-                serve_content = f.read()
-                f.close()
-                r = HttpResponse(content=serve_content, content_type='text/html')
-                r.send(socket)                
-            else:
-                handler = self.get_handlers.get(uri)
-                if handler:
-                    handler(socket)
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.socket.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+
+            # Event stream clients do not send anything, an empty read means they disconnected
+            if data == b'':
+                self.close_event_client(client)
+                return
+
+        if mask & selectors.EVENT_WRITE:
+            self.flush_event_client(client)
+
+
+    # Messages are only taken from the client queues once everything before was written
+    # Slow clients keep their undelivered messages in the bounded queues instead
+    def flush_event_client(self, client):
+
+        for _ in range(2):
+            if not client.pending:
+                client.pending = client.take_messages()
+                if not client.pending:
+                    break
+            try:
+                sent = client.socket.send(client.pending)
+                del client.pending[:sent]
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close_event_client(client)
+                return
+
+        if client.close_requested and not client.pending and not client.queue_depth():
+            self.close_event_client(client)
+            return
+
+        events = selectors.EVENT_READ
+        if client.pending:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.socket, events, client)
+
+
+    def close_event_client(self, client):
+
+        if client.socket is None:
+            return
+
+        self.event_clients = tuple(c for c in self.event_clients if c is not client)
+
+        if client.is_registered:
+            self.selector.unregister(client.socket)
+            client.is_registered = False
+
+        try:
+            client.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.socket.close()
+        client.socket = None
+        client.close_requested = True
 
-        elif method == 'POST':
-            handler = self.post_handlers.get(uri)
-            if handler:
-                contents = None
 
-                header_end = recv_data.find(b'\r\n\r\n')
+    def open_event_stream(self, socket, uri):
 
-                if header_end >= 0:
-                    i = recv_data.find(b'Content-Length:')
-                    if i >= 0 and i < header_end:
-                        j = recv_data.find(b'\r\n', i)
-                        try:
-                            contents_length = int(recv_data[i+15:j].decode().strip())
+        r = HttpResponse(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'}, stream=True)
+        r.send(socket)
 
-                            if contents_length >= 0:
-                                contents = recv_data[header_end+4:]
+        # The event loop takes over the socket
+        client = EventStreamClient(self, uri, socket)
+        self.call_in_loop(self.add_event_client, client)
 
-                            remaining_read_len = contents_length - len(contents)
 
-                            while remaining_read_len > 0:
-                                now_read_try_len = min(1024, remaining_read_len)
-                                now_read = socket.recv(now_read_try_len)
-                                contents += now_read
-                                remaining_read_len -= len(now_read)
-                        except:
-                            pass
-                            
-                handler(socket, contents)
+    # Serves requests of a connection until it becomes idle or is closed
+    def client_handler(self, connection):
+
+        socket = connection.socket
+
+        while True:
+            try:
+                request = HttpRequest.read(socket, connection.buffer)
+            except HttpRequest.ParseError as e:
+                try:
+                    HttpResponse(e.code, headers={'Connection': 'close'}).send(socket)
+                except OSError:
+                    pass
+                socket.close()
+                return
+            except SocketTimeout:
+                try:
+                    HttpResponse(408, headers={'Connection': 'close'}).send(socket)
+                except OSError:
+                    pass
+                socket.close()
+                return
+            except OSError:
+                socket.close()
+                return
+
+            if request is None:
+                socket.close()
+                return
+
+            try:
+                keep_socket = self.handle_request(socket, request)
+            except OSError:
+                socket.close()
+                return
+
+            # Socket was taken over, for example by an event stream
+            if not keep_socket:
+                return
+
+            if not request.keep_alive():
+                socket.close()
+                return
+
+            # Pipelined requests are served right away, otherwise wait in the event loop
+            if not connection.buffer:
+                break
+
+        self.call_in_loop(self.idle_connection, connection)
+
+
+    # Returns False if the socket must not be used for further requests by the server
+    def handle_request(self, socket, request):
+
+        start = time.perf_counter()
+
+        try:
+            return self.route_request(socket, request)
+        finally:
+            # Unknown paths and methods are grouped to keep the number of label values small
+            method = request.method if request.method in ['GET', 'POST'] else 'other'
+            route = request.path if self.is_route(request.path) else 'other'
+            http_requests.inc(method, route)
+            http_request_duration.observe(method, route, value=time.perf_counter() - start)
+
+
+    def is_route(self, path):
+
+        return path in self.event_streams or path in self.get_file_servers or path in self.get_handlers or path in self.post_handlers
+
+
+    def route_request(self, socket, request):
+
+        if request.method == 'GET':
+            if request.path in self.event_streams:
+                self.open_event_stream(socket, request.path)
+                return False
+
+            if request.path in self.get_file_servers:
+                try:
+                    content = self.get_file_content(request.path)
+                except OSError:
+                    HttpResponse(404).send(socket)
+                    return True
+                content.send(socket, request)
+                return True
+
+            handler = self.get_handlers.get(request.path)
+            if handler:
+                handler(socket, request)
+                return True
+
+            HttpResponse(404).send(socket)
+            return True
+
+        if request.method == 'POST':
+            handler = self.post_handlers.get(request.path)
+            if handler:
+                handler(socket, request.body)
+                return True
+
+            HttpResponse(404).send(socket)
+            return True
 
-        socket.close()
+        HttpResponse(405).send(socket)
+        return True
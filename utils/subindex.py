@@ -0,0 +1,79 @@
+import bisect
+import itertools
+
+
+class SubtitleIndex():
+
+    # Subs are grouped by duration, the last group takes all longer ones
+    # Lookups walk back from the bisected position only while earlier subs of a group can still be active,
+    # so in each group at most the subs that started up to its duration before are visited.
+    # Without the groups a single long sub (logo, sign, song) would make every lookup visit all earlier subs.
+    GROUP_DURATIONS = [10000, 60000, 600000, None]
+
+    def __init__(self, subs):
+
+        self.keys = [(s['start'], s['end']) for s in subs]
+
+        group_orders = [[] for _ in self.GROUP_DURATIONS]
+
+        for i in sorted(range(len(subs)), key=lambda i: self.keys[i]):
+            start, end = self.keys[i]
+            for order, max_duration in zip(group_orders, self.GROUP_DURATIONS):
+                if max_duration is None or end - start <= max_duration:
+                    order.append(i)
+                    break
+
+        # Per group positions in the list sorted by start, with ends and the running maximum of ends
+        self.groups = []
+
+        for order in group_orders:
+            if not order:
+                continue
+            starts = [self.keys[i][0] for i in order]
+            ends = [self.keys[i][1] for i in order]
+            max_ends = list(itertools.accumulate(ends, max))
+            self.groups.append((order, starts, ends, max_ends))
+
+
+    def __len__(self):
+
+        return len(self.keys)
+
+
+    def sort_by_start(self, indices):
+
+        indices.sort(key=lambda i: (self.keys[i], i))
+        return indices
+
+
+    # Returns the indices of all subs shown at time (in ms), ordered by start
+    def lookup(self, time):
+
+        ret = []
+
+        for order, starts, ends, max_ends in self.groups:
+            # Subs starting later can't be active, earlier ones only while the running maximum of ends is after time
+            j = bisect.bisect_right(starts, time) - 1
+
+            while j >= 0 and (max_ends[j] > time or starts[j] == time):
+                if ends[j] > time or starts[j] == time:
+                    ret.append(order[j])
+                j -= 1
+
+        return self.sort_by_start(ret)
+
+
+    # Returns the indices of all subs overlapping the time window [start, end) (in ms), ordered by start
+    def overlapping(self, start, end):
+
+        ret = []
+
+        for order, starts, ends, max_ends in self.groups:
+            j = bisect.bisect_left(starts, end) - 1
+
+            while j >= 0 and max_ends[j] > start:
+                if ends[j] > start:
+                    ret.append(order[j])
+                j -= 1
+
+        return self.sort_by_start(ret)